@@ -25,6 +25,7 @@ from bpy.props import (
         BoolProperty,
         EnumProperty,
         FloatProperty,
+        IntProperty,
         StringProperty,
         CollectionProperty,
         )
@@ -53,7 +54,7 @@ class ExportSCN(bpy.types.Operator, ExportHelper):
         
     # texture relative type
     texture_path_mode = bpy.props.EnumProperty(name="Relativity", 
-                                               items = (('abs', 'absolute',''), ('blend','to *.blend',''),('scn','to *.scn','')),
+                                               items = (('abs', 'absolute',''), ('blend','to *.blend',''),('scn','to *.scn',''),('pak','in *.scnpak','')),
                                                default='scn')
     
     # export things
@@ -61,6 +62,130 @@ class ExportSCN(bpy.types.Operator, ExportHelper):
                                            items = (('preserve', 'Export Modifiers',''), ('apply','Apply Before Export',''), ('noapply', 'Do Nothing', '')),
                                            default='preserve')
     
+    vertex_encoding = bpy.props.EnumProperty(name="Vertex Encoding", 
+                                             items = (('float', 'Full Precision',''), ('compact','Compact','')),
+                                             default='float')
+    
+    # mesh cache
+    use_mesh_cache = BoolProperty(
+        name="Cache Meshes",
+        description="Reuse encoded meshes from earlier exports when their data hasn't changed.",
+        default=False,
+        )
+        
+    mesh_cache_size = IntProperty(
+        name="Cache Size (MB)",
+        description="Least recently used meshes are dropped from the cache past this size.",
+        default=1024,
+        min=16,
+        )
+        
+    # gpu buffers
+    vertex_buffers = BoolProperty(
+        name="Vertex Buffers",
+        description="Also write welded vertex and triangle index buffers for each mesh, ready to upload to the GPU.",
+        default=False,
+        )
+        
+    optimize_triangles = BoolProperty(
+        name="Optimize Triangles",
+        description="Triangulate meshes and reorder triangles and vertices for the GPU vertex cache.",
+        default=False,
+        )
+        
+    # level of detail
+    lod_levels = IntProperty(
+        name="LOD Levels",
+        description="Number of decimated levels of detail to generate for each mesh.",
+        default=0,
+        min=0,
+        max=8,
+        )
+        
+    lod_ratio = FloatProperty(
+        name="LOD Ratio",
+        description="Fraction of faces each level of detail keeps from the one before it.",
+        default=0.5,
+        min=0.01,
+        max=1.0,
+        )
+        
+    # compression
+    compression = bpy.props.EnumProperty(name="Compression", 
+                                         items = (('none', 'None',''), ('zlib','zlib',''), ('lzma', 'LZMA', '')),
+                                         default='none')
+        
+    table_of_contents = BoolProperty(
+        name="Table of Contents",
+        description="End the file with an index of every chunk, with offsets and allocation sizes for loaders.",
+        default=False,
+        )
+        
+    # parallel encoding
+    mesh_workers = IntProperty(
+        name="Encoder Processes",
+        description="Number of processes encoding meshes. 1 encodes on the main thread, 0 uses one per CPU core.",
+        default=1,
+        min=0,
+        )
+        
+    stream_budget = IntProperty(
+        name="Mesh Memory Budget (MB)",
+        description="Meshes larger than this are written a slice at a time, skipping the cache, buffers and compression.",
+        default=512,
+        min=16,
+        )
+        
+    # skinning
+    skinning = BoolProperty(
+        name="Skinning",
+        description="Write per vertex bone indices and weights for meshes deformed by an armature.",
+        default=False,
+        )
+        
+    skin_influences = IntProperty(
+        name="Bones Per Vertex",
+        description="Number of heaviest bone influences kept for each vertex.",
+        default=4,
+        min=1,
+        max=8,
+        )
+        
+    skin_weight_bits = bpy.props.EnumProperty(name="Weight Precision", 
+                                              items = (('8', '8 bit',''), ('16','16 bit','')),
+                                              default='16')
+        
+    # animation
+    bake_animation = BoolProperty(
+        name="Bake Animation",
+        description="Resample every animation curve at a fixed rate instead of exporting its keyframes.",
+        default=False,
+        )
+        
+    bake_rate = FloatProperty(
+        name="Bake Rate",
+        description="Samples per second when baking animation.",
+        default=30.0,
+        min=1.0,
+        max=1000.0,
+        )
+        
+    anim_tolerance = FloatProperty(
+        name="Key Tolerance",
+        description="Remove keys that interpolation reproduces within this error (in exported units, 0 keeps every key).",
+        default=0.0,
+        min=0.0,
+        precision=4,
+        )
+        
+    anim_quantize_bits = IntProperty(
+        name="Key Quantization Bits",
+        description="Snap key times and values to this many bits over the range of each curve (0 disables).",
+        default=0,
+        min=0,
+        max=24,
+        )
+    
         
     def draw(self, context):
         layout = self.layout
@@ -71,6 +196,37 @@ class ExportSCN(bpy.types.Operator, ExportHelper):
         box = layout.box()
         box.label("Mesh settings")
         box.prop(self, "modifier_mode")
+        box.prop(self, "vertex_encoding")
+        box.prop(self, "vertex_buffers")
+        box.prop(self, "optimize_triangles")
+        box.prop(self, "lod_levels")
+        if self.lod_levels > 0:
+            box.prop(self, "lod_ratio")
+        box.prop(self, "use_mesh_cache")
+        if self.use_mesh_cache:
+            box.prop(self, "mesh_cache_size")
+        box.prop(self, "mesh_workers")
+        box.prop(self, "stream_budget")
+        
+        box = layout.box()
+        box.label("Armature settings")
+        box.prop(self, "skinning")
+        if self.skinning:
+            box.prop(self, "skin_influences")
+            box.prop(self, "skin_weight_bits")
+        
+        box = layout.box()
+        box.label("Animation settings")
+        box.prop(self, "bake_animation")
+        if self.bake_animation:
+            box.prop(self, "bake_rate")
+        box.prop(self, "anim_tolerance")
+        box.prop(self, "anim_quantize_bits")
+        
+        box = layout.box()
+        box.label("File settings")
+        box.prop(self, "compression")
+        box.prop(self, "table_of_contents")
         
         box = layout.box()
         box.label("Texture settings")
@@ -0,0 +1,93 @@
+# ##### BEGIN LICENSE BLOCK #####
+#
+# This program is licensed under Creative Commons BY-NC-SA:
+# https://creativecommons.org/licenses/by-nc-sa/3.0/
+#
+# Copyright (C) Dummiesman, 2016
+#
+# ##### END LICENSE BLOCK #####
+
+import os, tempfile
+
+CACHE_EXTENSION = ".chunk"
+
+
+def default_cache_directory():
+    return os.path.join(tempfile.gettempdir(), "scn_export_cache")
+
+
+class ChunkCache:
+    """size bounded on-disk cache of encoded chunk payloads, keyed by content hash.
+    least recently used entries (by file mtime) are evicted first"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # sizes of everything already in the cache
+        self.entries = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(CACHE_EXTENSION):
+                self.entries[entry.name] = entry.stat().st_size
+        self.total_bytes = sum(self.entries.values())
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + CACHE_EXTENSION)
+
+    def get(self, key):
+        path = self.path_for(key)
+        try:
+            with open(path, "rb") as cache_file:
+                payload = cache_file.read()
+        except OSError:
+            self.misses += 1
+            return None
+
+        # touch it so it counts as recently used
+        os.utime(path, None)
+        self.hits += 1
+        return payload
+
+    def put(self, key, payload):
+        # never keep anything that alone blows the budget
+        if len(payload) > self.max_bytes:
+            return
+
+        # write to a temp file first so a crash never leaves half an entry
+        path = self.path_for(key)
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as cache_file:
+            cache_file.write(payload)
+        os.replace(temp_path, path)
+
+        name = os.path.basename(path)
+        self.total_bytes += len(payload) - self.entries.get(name, 0)
+        self.entries[name] = len(payload)
+        self.evict()
+
+    def evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        # oldest first
+        def entry_mtime(name):
+            try:
+                return os.path.getmtime(os.path.join(self.directory, name))
+            except OSError:
+                return 0
+
+        for name in sorted(self.entries, key=entry_mtime):
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            self.total_bytes -= self.entries.pop(name)
+
+    def summary(self):
+        return "%d hits, %d misses, %.1f MB cached" % (self.hits, self.misses, self.total_bytes / (1024.0 * 1024.0))
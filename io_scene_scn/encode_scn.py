@@ -0,0 +1,539 @@
+# ##### BEGIN LICENSE BLOCK #####
+#
+# This program is licensed under Creative Commons BY-NC-SA:
+# https://creativecommons.org/licenses/by-nc-sa/3.0/
+#
+# Copyright (C) Dummiesman, 2016
+#
+# ##### END LICENSE BLOCK #####
+
+import io, math, struct, collections
+import numpy
+
+# MESH chunk payloads are encoded here from plain arrays, without touching bpy,
+# so this module can be imported by worker processes outside of Blender
+
+# vertex cache size the triangle optimizer targets and ACMR is measured with
+VERTEX_CACHE_SIZE = 16
+
+# target size of each slice of records written at once
+DEFAULT_SLICE_BYTES = 64 * 1024 * 1024
+
+# MESH v4 stream formats
+STREAM_FLOAT = 0
+STREAM_UNORM16_BOUNDS = 1 # positions, relative to the bounding box
+STREAM_OCTAHEDRAL_SNORM16 = 1 # normals
+STREAM_HALF = 1 # uvs
+STREAM_RGBA8 = 1 # colors
+
+
+######################################################
+# MESH ENCODING
+######################################################
+def encode_mesh_chunks(data, stats, chunk_types, options):
+  """encode the payloads of the given chunk types for one mesh. this is what worker processes run.
+  returns the payloads and (vertex, index) counts by chunk type, and report lines for the log"""
+  payloads = {}
+  counts = {}
+  report = []
+  
+  # optional stages first
+  if options.get("OPTIMIZE_TRIANGLES"):
+    acmr_before = measure_acmr(data)
+    data = optimize_triangles(data)
+    report.append("ACMR %.3f -> %.3f" % (acmr_before, measure_acmr(data)))
+  
+  for chunk_type in chunk_types:
+    buffer = io.BytesIO()
+    if chunk_type == "MESH":
+      encode_mesh_data(buffer, data, stats, options.get("VERTEX_ENCODING") == 'compact')
+      counts[chunk_type] = (len(data["positions"]), len(data["loop_verts"]))
+    elif chunk_type == "VBUF":
+      counts[chunk_type] = encode_vertex_buffer_data(buffer, data, stats)
+    payloads[chunk_type] = buffer.getvalue()
+  return payloads, counts, report
+
+
+def encode_mesh_data(file, data, stats, compact=False, slice_bytes=DEFAULT_SLICE_BYTES):
+  write_string(file, data["name"])
+  
+  # write mesh info
+  file.write(struct.pack("<H", (1 if data["auto_smooth"] else 0)))
+  file.write(struct.pack("<H", (1 if stats["vertex_count"] <= 65535 else 0)))
+  
+  # write bounding box
+  file.write(struct.pack("<fff", *stats["bbox_min"]))
+  file.write(struct.pack("<fff", *stats["bbox_max"]))
+  file.write(struct.pack("<fff", *stats["bbox_center"]))
+  
+  # write stream formats, only MESH v4 has these
+  if compact:
+    file.write(struct.pack("<HHHH", STREAM_UNORM16_BOUNDS, STREAM_OCTAHEDRAL_SNORM16, STREAM_HALF, STREAM_RGBA8))
+  
+  # index width depends on the vertex count
+  num_verts = stats["vertex_count"]
+  compact_indices = (num_verts <= 65535) # if we have less than 65535 verts, use short instead of long  
+  index_type = "<u2" if compact_indices else "<u4"
+  
+  # classify edges we want to export, and their tags
+  edges = classify_edges(data, index_type)
+  
+  # write tag list
+  file.write(struct.pack("<H", len(edges["tags"])))
+  for tag in edges["tags"]:
+    write_string(file, tag)
+  
+  # write color and uv layers
+  file.write(struct.pack("<HH", len(data["uv_layers"]), len(data["vc_layers"])))
+  
+  for layer_name, layer_active in data["uv_layers"]:
+    write_string(file, layer_name)
+    file.write(struct.pack("<H", (1 if layer_active else 0)))
+    
+  for layer_name, layer_active in data["vc_layers"]:
+    write_string(file, layer_name)
+    file.write(struct.pack("<H", (1 if layer_active else 0)))
+  
+  # write tag links
+  file.write(struct.pack("<I", len(edges["links"])))
+  file.write(edges["links"].tobytes())
+  
+  # write geometry
+  num_materials = data["num_materials"]
+  file.write(struct.pack("<III", num_verts, len(edges["export_edges"]), num_materials))
+  
+  # vertices and edges go out a slice at a time, so temporary records stay small
+  slice_size = max(slice_bytes // build_vertex_records(data, stats, compact, slice(0, 0)).itemsize, 1)
+  for start in range(0, num_verts, slice_size):
+    file.write(build_vertex_records(data, stats, compact, slice(start, start + slice_size)).tobytes())
+  
+  slice_size = max(slice_bytes // edges["record_type"].itemsize, 1)
+  for start in range(0, len(edges["export_edges"]), slice_size):
+    file.write(build_edge_records(data, edges, slice(start, start + slice_size)).tobytes())
+  
+  # sort faces into (material, num sides) buckets in one pass
+  buckets = bucket_faces(data, num_materials)
+  loop_size = build_loop_records(data, index_type, compact, []).itemsize
+  
+  # write FaceContainers
+  face_offset = 0
+  for mat_index in range(num_materials):
+    mat_buckets = numpy.flatnonzero(buckets["materials"] == mat_index)
+    
+    #write facecontainer 
+    file.write(struct.pack("<H", len(mat_buckets)))
+    
+    # write primgroups, each one is a contiguous block of loops
+    for bucket in mat_buckets.tolist():
+      num_faces = int(buckets["counts"][bucket])
+      num_sides = int(buckets["sides"][bucket])
+      file.write(struct.pack("<IH", num_faces, num_sides))
+      
+      # interleave every loop as it's written : vertex index, uvs, colors
+      slice_size = max(slice_bytes // (loop_size * num_sides), 1)
+      for start in range(face_offset, face_offset + num_faces, slice_size):
+        faces = buckets["faces"][start:min(start + slice_size, face_offset + num_faces)]
+        file.write(build_loop_records(data, index_type, compact, gather_face_loops(data, faces)).tobytes())
+      face_offset += num_faces
+
+
+def encode_vertex_buffer_data(file, data, stats):
+  # weld loops into unique vertices
+  vertices, loop_vertices = weld_loop_vertices(data)
+  compact_indices = (len(vertices) <= 65535)
+  index_type = "<u2" if compact_indices else "<u4"
+  
+  # write vertex buffer
+  file.write(struct.pack("<HH", len(data["uvs"]), len(data["colors"])))
+  file.write(struct.pack("<IH", len(vertices), (1 if compact_indices else 0)))
+  file.write(vertices.tobytes())
+  
+  # write one triangle list per material
+  triangles, triangle_faces = triangulate_faces(data)
+  triangle_materials = numpy.clip(data["material_indices"][triangle_faces], 0, data["num_materials"] - 1)
+  
+  file.write(struct.pack("<H", data["num_materials"]))
+  for mat_index in range(data["num_materials"]):
+    indices = loop_vertices[triangles[triangle_materials == mat_index]]
+    file.write(struct.pack("<I", indices.size))
+    file.write(indices.astype(index_type).tobytes())
+  
+  return len(vertices), triangles.size
+
+
+def compute_mesh_stats(data):
+  """compute bounds, bounding sphere and counts from the extracted mesh data"""
+  positions = data["positions"]
+  loop_totals = data["loop_totals"]
+  
+  stats = {}
+  stats["vertex_count"] = len(positions)
+  stats["loop_count"] = int(loop_totals.sum())
+  stats["triangle_count"] = int((loop_totals - 2).sum())
+  
+  if len(positions) == 0:
+    stats["bbox_min"] = stats["bbox_max"] = stats["bbox_center"] = [0.0, 0.0, 0.0]
+    stats["radius"] = 0.0
+    return stats
+  
+  bnd_min = positions.min(axis=0).astype(numpy.float64)
+  bnd_max = positions.max(axis=0).astype(numpy.float64)
+  bnd_center = (bnd_min + bnd_max) / 2
+  
+  stats["bbox_min"] = bnd_min.tolist()
+  stats["bbox_max"] = bnd_max.tolist()
+  stats["bbox_center"] = bnd_center.tolist()
+  
+  # radius is measured a slice at a time, positions can be memory mapped
+  radius_squared = 0.0
+  slice_size = 1 << 20
+  for start in range(0, len(positions), slice_size):
+    offsets = positions[start:start + slice_size] - bnd_center
+    radius_squared = max(radius_squared, float((offsets ** 2).sum(axis=1).max()))
+  stats["radius"] = math.sqrt(radius_squared)
+  return stats
+
+
+def classify_edges(data, index_type):
+  """find sharp, seam and creased edges, and build their tag list, tag links and edge records"""
+  sharp = ~data["edge_smooth"]
+  seam = data["edge_seam"]
+  crease = data["edge_crease"]
+  
+  # only tagged or creased edges are exported, remapped to their position in this list
+  export_edges = numpy.flatnonzero(sharp | seam | (crease > 0))
+  export_sharp = numpy.flatnonzero(sharp[export_edges])
+  export_seam = numpy.flatnonzero(seam[export_edges])
+  
+  # tags are listed in the order they first show up, sharp before seam on the same edge
+  tag_firsts = []
+  if len(export_sharp) > 0:
+    tag_firsts.append((int(export_sharp[0]), 0, "SHARP"))
+  if len(export_seam) > 0:
+    tag_firsts.append((int(export_seam[0]), 1, "SEAM"))
+  tags = [tag[2] for tag in sorted(tag_firsts)]
+  
+  # tag links, per edge in order, sharp link before seam link
+  link_edges = numpy.concatenate((export_sharp, export_seam))
+  link_tags = numpy.concatenate((numpy.full(len(export_sharp), tags.index("SHARP") if "SHARP" in tags else 0),
+                                 numpy.full(len(export_seam), tags.index("SEAM") if "SEAM" in tags else 0)))
+  link_order = numpy.argsort(link_edges, kind="mergesort")
+  
+  links = numpy.empty(len(link_edges), dtype=[("type", "<u2"), ("tag", "<u2"), ("index", index_type)])
+  links["type"] = 1
+  links["tag"] = link_tags[link_order]
+  links["index"] = link_edges[link_order]
+  
+  edges = {}
+  edges["tags"] = tags
+  edges["links"] = links
+  edges["export_edges"] = export_edges
+  edges["record_type"] = numpy.dtype([("verts", index_type, 2), ("crease", "<f4")])
+  return edges
+
+
+def build_edge_records(data, edges, export_slice):
+  """vertex indices and crease of a slice of the exported edges"""
+  export_edges = edges["export_edges"][export_slice]
+  records = numpy.empty(len(export_edges), dtype=edges["record_type"])
+  records["verts"] = data["edge_verts"][export_edges]
+  records["crease"] = data["edge_crease"][export_edges]
+  return records
+
+
+def optimize_triangles(data):
+  """triangulate every face and reorder triangles for vertex cache reuse, per material.
+  vertices are then renumbered in the order the triangles first use them"""
+  triangles, triangle_faces = triangulate_faces(data)
+  triangle_materials = numpy.clip(data["material_indices"][triangle_faces], 0, data["num_materials"] - 1)
+  
+  # reorder triangles within each material, materials stay in order
+  ordered = []
+  for mat_index in range(data["num_materials"]):
+    mat_triangles = triangles[triangle_materials == mat_index]
+    order = tipsify(data["loop_verts"][mat_triangles], len(data["positions"]), VERTEX_CACHE_SIZE)
+    ordered.append(mat_triangles[order])
+  triangles = numpy.concatenate(ordered) if len(ordered) > 0 else triangles
+  triangle_materials = numpy.sort(triangle_materials, kind="mergesort")
+  
+  # every triangle corner becomes a loop
+  loop_source = triangles.ravel()
+  loop_verts = data["loop_verts"][loop_source]
+  
+  # renumber vertices by first use, unused ones go last
+  used_verts, first_use = numpy.unique(loop_verts, return_index=True)
+  unused_verts = numpy.setdiff1d(numpy.arange(len(data["positions"])), used_verts)
+  new_to_old = numpy.concatenate((used_verts[numpy.argsort(first_use, kind="mergesort")], unused_verts))
+  old_to_new = numpy.empty_like(new_to_old)
+  old_to_new[new_to_old] = numpy.arange(len(new_to_old))
+  
+  optimized = dict(data)
+  optimized["positions"] = data["positions"][new_to_old]
+  optimized["normals"] = data["normals"][new_to_old]
+  optimized["edge_verts"] = old_to_new[data["edge_verts"]]
+  optimized["loop_verts"] = old_to_new[loop_verts]
+  optimized["loop_starts"] = numpy.arange(len(triangles), dtype=numpy.int64) * 3
+  optimized["loop_totals"] = numpy.full(len(triangles), 3, dtype=numpy.int64)
+  optimized["material_indices"] = triangle_materials
+  optimized["triangles"] = numpy.arange(len(triangles) * 3, dtype=numpy.int64).reshape(-1, 3)
+  optimized["triangle_faces"] = numpy.arange(len(triangles), dtype=numpy.int64)
+  optimized["uvs"] = [uv[loop_source] for uv in data["uvs"]]
+  optimized["colors"] = [color[loop_source] for color in data["colors"]]
+  return optimized
+
+
+def tipsify(triangle_verts, num_verts, cache_size):
+  """order triangles for a FIFO vertex cache (Sander, Nehab and Barczak 2007).
+  takes the vertex indices of each triangle, returns the new triangle order"""
+  num_triangles = len(triangle_verts)
+  if num_triangles == 0:
+    return numpy.zeros(0, dtype=numpy.int64)
+  
+  # triangles using each vertex
+  corner_verts = triangle_verts.ravel()
+  use_counts = numpy.bincount(corner_verts, minlength=num_verts)
+  adjacency_starts = (numpy.cumsum(use_counts) - use_counts).tolist()
+  adjacency = (numpy.argsort(corner_verts, kind="mergesort") // 3).tolist()
+  
+  live_counts = use_counts.tolist()
+  triangle_list = triangle_verts.tolist()
+  cache_time = [0] * num_verts
+  emitted = [False] * num_triangles
+  dead_ends = []
+  order = []
+  
+  time_stamp = cache_size + 1
+  cursor = 0
+  fan_vert = int(corner_verts[0])
+  
+  while fan_vert >= 0:
+    candidates = []
+    
+    # emit every triangle around the fanning vertex
+    start = adjacency_starts[fan_vert]
+    for triangle in adjacency[start:start + use_counts[fan_vert]]:
+      if emitted[triangle]:
+        continue
+      for vert in triangle_list[triangle]:
+        dead_ends.append(vert)
+        candidates.append(vert)
+        live_counts[vert] -= 1
+        if time_stamp - cache_time[vert] > cache_size:
+          cache_time[vert] = time_stamp
+          time_stamp += 1
+      emitted[triangle] = True
+      order.append(triangle)
+    
+    # pick the candidate that will still be in the cache with the most triangles left
+    fan_vert = -1
+    best_priority = -1
+    for vert in candidates:
+      if live_counts[vert] > 0:
+        priority = 0
+        if time_stamp - cache_time[vert] + 2 * live_counts[vert] <= cache_size:
+          priority = time_stamp - cache_time[vert]
+        if priority > best_priority:
+          best_priority = priority
+          fan_vert = vert
+    
+    # otherwise go back through recently used vertices, then everything else
+    if fan_vert < 0:
+      while len(dead_ends) > 0:
+        vert = dead_ends.pop()
+        if live_counts[vert] > 0:
+          fan_vert = vert
+          break
+    if fan_vert < 0:
+      while cursor < num_verts:
+        if live_counts[cursor] > 0:
+          fan_vert = cursor
+          break
+        cursor += 1
+  
+  return numpy.array(order, dtype=numpy.int64)
+
+
+def measure_acmr(data):
+  """average FIFO cache miss count per triangle, in the order triangulate_faces gives them"""
+  triangles, triangle_faces = triangulate_faces(data)
+  if len(triangles) == 0:
+    return 0.0
+  
+  cache = collections.deque()
+  cached = set()
+  misses = 0
+  for vert in data["loop_verts"][triangles].ravel().tolist():
+    if vert in cached:
+      continue
+    misses += 1
+    cache.append(vert)
+    cached.add(vert)
+    if len(cache) > VERTEX_CACHE_SIZE:
+      cached.discard(cache.popleft())
+  return misses / float(len(triangles))
+
+
+def weld_loop_vertices(data):
+  """build a record of (position, normal, uvs, colors) for every loop and weld identical ones.
+  returns the unique vertices in order of first use, and the vertex index of every loop"""
+  loop_verts = data["loop_verts"]
+  
+  fields = [("position", "<f4", 3), ("normal", "<f4", 3)]
+  fields += [("uv%d" % i, "<f4", 2) for i in range(len(data["uvs"]))]
+  fields += [("color%d" % i, "<f4", 4) for i in range(len(data["colors"]))]
+  
+  records = numpy.empty(len(loop_verts), dtype=fields)
+  records["position"] = data["positions"][loop_verts]
+  records["normal"] = data["normals"][loop_verts]
+  for i, uv in enumerate(data["uvs"]):
+    records["uv%d" % i] = uv
+  for i, color in enumerate(data["colors"]):
+    records["color%d" % i][:, :3] = color
+    records["color%d" % i][:, 3] = 1.0
+  
+  # hash the raw bytes of each record
+  record_keys = records.view(numpy.dtype((numpy.void, records.dtype.itemsize)))
+  unique_keys, first_loop, loop_vertices = numpy.unique(record_keys, return_index=True, return_inverse=True)
+  
+  # keep vertices in order of first use, it's friendlier to the vertex fetch
+  vertex_order = numpy.argsort(first_loop, kind="mergesort")
+  vertex_rank = numpy.empty_like(vertex_order)
+  vertex_rank[vertex_order] = numpy.arange(len(vertex_order))
+  
+  return records[first_loop[vertex_order]], vertex_rank[loop_vertices.ravel()]
+
+
+def triangulate_faces(data):
+  """loop indices of every triangle, and the face it came from. uses the tessellation
+  extracted with the mesh, meshes without one are fan triangulated"""
+  if "triangles" in data:
+    return data["triangles"], data["triangle_faces"]
+  
+  loop_totals = data["loop_totals"]
+  triangle_counts = numpy.maximum(loop_totals - 2, 0)
+  triangle_faces = numpy.repeat(numpy.arange(len(loop_totals)), triangle_counts)
+  
+  triangle_offsets = numpy.cumsum(triangle_counts) - triangle_counts
+  fan_index = numpy.arange(len(triangle_faces)) - numpy.repeat(triangle_offsets, triangle_counts)
+  first_loop = data["loop_starts"][triangle_faces]
+  
+  triangles = numpy.empty((len(triangle_faces), 3), dtype=numpy.int64)
+  triangles[:, 0] = first_loop
+  triangles[:, 1] = first_loop + fan_index + 1
+  triangles[:, 2] = first_loop + fan_index + 2
+  return triangles, triangle_faces
+
+
+def build_vertex_records(data, stats, compact, vertices):
+  """interleave position and normal of the given vertices into one record array"""
+  positions = data["positions"][vertices]
+  normals = data["normals"][vertices]
+  
+  if not compact:
+    records = numpy.empty(len(positions), dtype=[("position", "<f4", 3), ("normal", "<f4", 3)])
+  else:
+    records = numpy.empty(len(positions), dtype=[("position", "<u2", 3), ("normal", "<i2", 2)])
+    positions = quantize_positions(positions, stats)
+    normals = encode_octahedral(normals)
+    
+  records["position"] = positions
+  records["normal"] = normals
+  return records
+
+
+def build_loop_records(data, index_type, compact, loops):
+  """interleave vertex index, uvs and colors of the given loops into one record array"""
+  uv_type = "<f2" if compact else "<f4"
+  color_type = "u1" if compact else "<f4"
+  
+  fields = [("vert", index_type)]
+  fields += [("uv%d" % i, uv_type, 2) for i in range(len(data["uvs"]))]
+  fields += [("color%d" % i, color_type, 4) for i in range(len(data["colors"]))]
+  
+  records = numpy.empty(len(loops), dtype=fields)
+  records["vert"] = data["loop_verts"][loops]
+  for i, uv in enumerate(data["uvs"]):
+    records["uv%d" % i] = uv[loops]
+  for i, color in enumerate(data["colors"]):
+    color = color[loops]
+    
+    # colors are written with a constant full alpha
+    if compact:
+      records["color%d" % i][:, :3] = numpy.rint(numpy.clip(color, 0.0, 1.0) * 255)
+      records["color%d" % i][:, 3] = 255
+    else:
+      records["color%d" % i][:, :3] = color
+      records["color%d" % i][:, 3] = 1.0
+  return records
+
+
+def quantize_positions(positions, stats):
+  """map positions to 0..65535 across the bounding box, flat axes map to 0"""
+  bbox_min = numpy.array(stats["bbox_min"])
+  extent = numpy.array(stats["bbox_max"]) - bbox_min
+  scale = numpy.zeros(3)
+  scale[extent > 0] = 65535.0 / extent[extent > 0]
+  return numpy.rint(numpy.clip((positions - bbox_min) * scale, 0, 65535))
+
+
+def encode_octahedral(normals):
+  """octahedral encode unit normals to two snorm16 values"""
+  normals = numpy.asarray(normals, dtype=numpy.float64)
+  length = numpy.abs(normals).sum(axis=1)
+  length[length == 0] = 1.0
+  projected = normals / length[:, None]
+  
+  # fold the lower hemisphere over the diagonals
+  x = projected[:, 0].copy()
+  y = projected[:, 1].copy()
+  lower = projected[:, 2] < 0
+  sign_x = numpy.where(x >= 0, 1.0, -1.0)
+  sign_y = numpy.where(y >= 0, 1.0, -1.0)
+  x[lower] = (1.0 - numpy.abs(projected[lower, 1])) * sign_x[lower]
+  y[lower] = (1.0 - numpy.abs(projected[lower, 0])) * sign_y[lower]
+  
+  return numpy.rint(numpy.clip(numpy.stack((x, y), axis=1), -1.0, 1.0) * 32767)
+
+
+def bucket_faces(data, num_materials):
+  """group face indices by (material, num sides) with a single stable sort.
+  buckets are ordered by material, then by the first face using each side count"""
+  face_materials = numpy.clip(data["material_indices"], 0, num_materials - 1).astype(numpy.int64)
+  loop_totals = data["loop_totals"].astype(numpy.int64)
+  
+  # one key per face, unique keys become the buckets
+  max_sides = int(loop_totals.max()) if len(loop_totals) > 0 else 0
+  keys = face_materials * (max_sides + 1) + loop_totals
+  unique_keys, first_seen, face_bucket, counts = numpy.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+  
+  # order buckets by material, then by first appearance
+  bucket_order = numpy.lexsort((first_seen, face_materials[first_seen]))
+  bucket_rank = numpy.empty_like(bucket_order)
+  bucket_rank[bucket_order] = numpy.arange(len(bucket_order))
+  
+  buckets = {}
+  buckets["faces"] = numpy.argsort(bucket_rank[face_bucket], kind="mergesort")
+  buckets["materials"] = face_materials[first_seen][bucket_order]
+  buckets["sides"] = loop_totals[first_seen][bucket_order]
+  buckets["counts"] = counts[bucket_order]
+  return buckets
+
+
+def gather_face_loops(data, faces):
+  """loop indices of the given faces, in face order"""
+  loop_totals = data["loop_totals"][faces]
+  face_offsets = numpy.cumsum(loop_totals) - loop_totals
+  offset_in_face = numpy.arange(int(loop_totals.sum())) - numpy.repeat(face_offsets, loop_totals)
+  return numpy.repeat(data["loop_starts"][faces], loop_totals) + offset_in_face
+
+
+######################################################
+# HELPERS
+######################################################
+def write_string(file, strng):
+  file.write(struct.pack("B", len(strng)))
+  file.write(strng.encode("ascii"))
+  
+  if (len(strng) % 2) == 0:
+    # write padding byte. hacky but it works
+    file.write("\x00".encode("ascii"))
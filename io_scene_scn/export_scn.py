@@ -7,15 +7,34 @@
 #
 # ##### END LICENSE BLOCK #####
 
-import os, time, struct, math, sys
+import os, io, time, math, sys, hashlib, collections, contextlib, functools, shutil, zlib, lzma, tempfile
+import concurrent.futures, concurrent.futures.process, multiprocessing, multiprocessing.spawn, queue, threading
 import os.path as path
 
 import bpy, bmesh, mathutils
+import numpy
+
+from .cache_scn import ChunkCache, default_cache_directory
+from .encode_scn import compute_mesh_stats, encode_mesh_chunks, encode_mesh_data, write_string
+from .pak_scn import ResourcePack, pak_path_for
+from .schema_scn import (
+        UINT16, UINT32, INT32, FLOAT, VEC2, VEC3, VEC4, UINT16_PAIR,
+        CHUNK_INFO, DATZ_HEADER,
+        OBJECT_TRANSFORM, OBJECT_STATE,
+        MATERIAL_COLORS, TEXTURE_REFERENCE,
+        COLLISION_BOUNDS, RIGIDBODY, CONSTRAINT_INFO,
+        SPLINE_HEADER, SPLINE_POINT, BEZIER_POINT,
+        VERTEX_GROUP_RUN, ANIM_HEADER, BONE, SKIN_HEADER, MATRIX4,
+        PAK_REFERENCE, UINT64, TOC_ENTRY, MESH_COUNTS,
+        pack_records,
+        )
 
 current_id = -1
 
 # maps
 armature_map = {}
+bone_maps = {}
+skin_map = {}
 action_map = {}
 camera_map = {}
 sound_map = {}
@@ -26,6 +45,9 @@ material_map = {}
 lamp_map = {}
 texture_map = {}
 mesh_map = {}
+mesh_stats_map = {}
+mesh_counts_map = {}
+lod_map = {}
 curve_map = {}
 rigidbody_map = {}
 vertex_group_map = {}
@@ -36,6 +58,31 @@ modifier_map = {}
 export_options = {}
 export_path = None
 
+# encoded mesh payload cache, if enabled
+mesh_cache = None
+
+# temporary meshes with modifiers applied
+evaluated_meshes = None
+
+# process pool encoding mesh payloads, if enabled
+encoder_pool = None
+encoder_pool_size = 1
+pool_encode_mesh_chunks = encode_mesh_chunks
+worker_module_path = None
+
+# threads compressing chunk payloads, if enabled
+compressor_pool = None
+compressor_pool_size = 1
+
+# resources embedded so far this export, by size
+embedded_resources = {}
+
+# content hashes of resource files, by (path, size, mtime). kept between exports
+resource_hash_cache = {}
+
+# companion .scnpak resources are written to, if enabled
+resource_pack = None
+
 # constants
 light_type_dict = {'POINT': 0, 'SPOT': 1, 'SUN':2, 'AREA':3}
 texture_blend_type_dict = {'MIX': 0, 
@@ -86,16 +133,16 @@ def write_modifier_chunk(file, modifier):
     ptr = create_chunk(file, "MDFR", 1, get_uuid())
     
     # write type
-    file.write(struct.pack("<H", modifier_type_dict.get(modifier.type)))
+    file.write(UINT16.pack(modifier_type_dict.get(modifier.type)))
       
     # write modifier specific data (TODO: seperate? maybe in its own .py file?)
     if modifier.type == 'EDGE_SPLIT':
-      file.write(struct.pack("<H", 1 if modifier.use_edge_sharp else 0))
-      file.write(struct.pack("<H", 1 if modifier.use_edge_angle else 0))
+      file.write(UINT16.pack(1 if modifier.use_edge_sharp else 0))
+      file.write(UINT16.pack(1 if modifier.use_edge_angle else 0))
       
       # write angle if specified
       if modifier.use_edge_angle:
-        file.write(struct.pack("<f", modifier.split_angle * 57.2958))
+        file.write(FLOAT.pack(modifier.split_angle * 57.2958))
     elif modifier.type == 'MIRROR':
       # create axis bitfield
       axis_id = 0
@@ -106,7 +153,7 @@ def write_modifier_chunk(file, modifier):
       if modifier.use_z:
         axis_id |= 4
         
-      file.write(struct.pack("<H", axis_id))
+      file.write(UINT16.pack(axis_id))
       
       # create uv axis bitfield
       uv_axis_id = 0
@@ -115,48 +162,48 @@ def write_modifier_chunk(file, modifier):
       if modifier.use_mirror_v:
         uv_axis_id |= 2
       
-      file.write(struct.pack("<H", uv_axis_id))
+      file.write(UINT16.pack(uv_axis_id))
       
       # write the rest
-      file.write(struct.pack("<H", 1 if modifier.use_clip else 0))
-      file.write(struct.pack("<H", 1 if modifier.use_mirror_merge else 0))
+      file.write(UINT16.pack(1 if modifier.use_clip else 0))
+      file.write(UINT16.pack(1 if modifier.use_mirror_merge else 0))
       
       # write if applicable
       if modifier.use_mirror_merge:
-        file.write(struct.pack("<f", modifier.merge_threshold)) 
+        file.write(FLOAT.pack(modifier.merge_threshold)) 
     elif modifier.type == 'SUBSURF':
-      file.write(struct.pack("<H", modifier.levels))
-      file.write(struct.pack("<H", 0 if modifier.subdivision_type == 'SIMPLE' else 1))
+      file.write(UINT16.pack(modifier.levels))
+      file.write(UINT16.pack(0 if modifier.subdivision_type == 'SIMPLE' else 1))
     elif modifier.type == 'ARRAY':
-      file.write(struct.pack("<H", modifier.count - 1))
+      file.write(UINT16.pack(modifier.count - 1))
       
       # write type
       if modifier.use_relative_offset:
-        file.write(struct.pack("<H", 0))
+        file.write(UINT16.pack(0))
       elif modifier.use_constant_offset:
-        file.write(struct.pack("<H", 1))        
+        file.write(UINT16.pack(1))        
       elif modifier.use_object_offset:
-        file.write(struct.pack("<H", 2))
+        file.write(UINT16.pack(2))
       
       # write offset or datablock id
       if modifier.use_object_offset:
-        file.write(struct.pack("<i", object_map.get(modifier.offset_object.name, -1)))
+        file.write(INT32.pack(object_map.get(modifier.offset_object.name, -1)))
       else:
         offset = [0.0, 0.0, 0.0]
         if modifier.use_relative_offset:
           offset = modifier.relative_offset_displace
         else:
           offset = modifier.constant_offset_displace
-        file.write(struct.pack("<fff", *offset))
+        file.write(VEC3.pack(*offset))
         
       # write merge settings
-      file.write(struct.pack("<H", 1 if modifier.use_merge_vertices else 0))
+      file.write(UINT16.pack(1 if modifier.use_merge_vertices else 0))
       if modifier.use_merge_vertices:
-        file.write(struct.pack("<f", modifier.merge_threshold))
+        file.write(FLOAT.pack(modifier.merge_threshold))
     elif modifier.type == 'BOOLEAN':
-      file.write(struct.pack("<i", object_map.get(modifier.object.name, -1)))
-      file.write(struct.pack("<H", boolean_operator_dict.get(modifier.operation, 0)))
-      file.write(struct.pack("<H", 0 if modifier.solver == 'CARVE' else 1))
+      file.write(INT32.pack(object_map.get(modifier.object.name, -1)))
+      file.write(UINT16.pack(boolean_operator_dict.get(modifier.operation, 0)))
+      file.write(UINT16.pack(0 if modifier.solver == 'CARVE' else 1))
       
     # close chunk
     close_chunk(file, ptr)
@@ -171,7 +218,7 @@ def write_meta_chunk(file, pairs, type = "META"):
     ptr = create_chunk(file, type, 1, get_uuid())
     
     num_pairs = len(pairs)
-    file.write(struct.pack("<I", num_pairs))
+    file.write(UINT32.pack(num_pairs))
     
     # write pairs
     for pair in pairs:
@@ -191,46 +238,129 @@ def write_light_chunk(file, light):
     ptr = create_chunk(file, "LGHT", 1, get_uuid())
     
     # write type
-    file.write(struct.pack("<H", light_type_dict.get(light.type, 0)))
+    file.write(UINT16.pack(light_type_dict.get(light.type, 0)))
       
     # write color
     color = (light.color[0], light.color[1], light.color[2], 1.0)
-    file.write(struct.pack("<ffff", *color))
+    file.write(VEC4.pack(*color))
     
     # write obvious data
-    file.write(struct.pack("<f", light.energy))
+    file.write(FLOAT.pack(light.energy))
     
     # write shadow data
-    file.write(struct.pack("<H", (0 if light.shadow_method == 'NOSHADOW' else 1)))
+    file.write(UINT16.pack((0 if light.shadow_method == 'NOSHADOW' else 1)))
     
     if light.shadow_method != 'NOSHADOW':
       shadow_color = (light.shadow_color[0],light.shadow_color[1], light.shadow_color[2], 1.0)
-      file.write(struct.pack("<ffff", *shadow_color))
-      file.write(struct.pack("<f", light.shadow_soft_size))
+      file.write(VEC4.pack(*shadow_color))
+      file.write(FLOAT.pack(light.shadow_soft_size))
     
     if light.type == 'POINT' or light.type == 'SPOT' or light.type == 'AREA':
-      file.write(struct.pack("<f", light.distance))
+      file.write(FLOAT.pack(light.distance))
       
     if light.type == 'SPOT':
       inner_angle_percent = 1.0 - light.spot_blend
       real_angle = (light.spot_size / 3.14159) * 180.0
-      file.write(struct.pack("<f", real_angle))
-      file.write(struct.pack("<f", real_angle * inner_angle_percent))
+      file.write(FLOAT.pack(real_angle))
+      file.write(FLOAT.pack(real_angle * inner_angle_percent))
     elif light.type == 'AREA':
       if light.shape == 'RECTANGLE':
-        file.write(struct.pack("<ff", light.size, light.size_y))
+        file.write(VEC2.pack(light.size, light.size_y))
       else:
-        file.write(struct.pack("<ff", light.size, light.size))
+        file.write(VEC2.pack(light.size, light.size))
     # close chunk
     close_chunk(file, ptr)
 
+def resource_digest(source_path, packed_file):
+  """content hash of a resource, files are only read again when they've changed"""
+  if packed_file is not None:
+    return hashlib.sha1(packed_file.data).hexdigest()
+  
+  stat = os.stat(source_path)
+  key = (os.path.realpath(source_path), stat.st_size, stat.st_mtime_ns)
+  digest = resource_hash_cache.get(key)
+  if digest is None:
+    hasher = hashlib.sha1()
+    with open(source_path, "rb") as source:
+      for data in iter(lambda: source.read(COPY_BUFFER_SIZE), b""):
+        hasher.update(data)
+    digest = hasher.hexdigest()
+    resource_hash_cache[key] = digest
+  return digest
+
+
+def find_embedded_resource(data_length, source_path, packed_file):
+  """chunk id of an identical resource embedded earlier in this export, or None.
+  only resources of the same size are ever hashed"""
+  candidates = embedded_resources.setdefault(data_length, [])
+  
+  digest = None
+  for candidate in candidates:
+    # the same file on disk needs no hashing
+    if packed_file is None and candidate["packed_file"] is None and os.path.realpath(source_path) == os.path.realpath(candidate["path"]):
+      return candidate["id"]
+    
+    if digest is None:
+      digest = resource_digest(source_path, packed_file)
+    if candidate["digest"] is None:
+      candidate["digest"] = resource_digest(candidate["path"], candidate["packed_file"])
+    if candidate["digest"] == digest:
+      return candidate["id"]
+  
+  candidates.append({"path" : source_path, "packed_file" : packed_file, "id" : current_id, "digest" : digest})
+  return None
+
+
+def write_embedded_resource(file, source_path, packed_file):
+  """write the embed flag, length and contents of a resource, from blender's packed copy if it
+  has one. resources identical to one embedded earlier reference its chunk instead"""
+  if packed_file is not None:
+    data_length = packed_file.size
+  else:
+    data_length = os.path.getsize(source_path)
+  
+  # already in the file?
+  original_id = find_embedded_resource(data_length, source_path, packed_file)
+  if original_id is not None:
+    file.write(UINT16.pack(2))
+    file.write(UINT32.pack(original_id))
+    return
+  
+  file.write(UINT16.pack(1))
+  file.write(UINT32.pack(data_length))
+  if packed_file is not None:
+    file.write(memoryview(packed_file.data))
+  else:
+    write_file_contents(file, source_path, data_length)
+  
+  # add padding if we need it
+  if data_length % 2 > 0:
+    file.write(b"\x00")
+
+
+def write_packed_resource(file, source_path, packed_file):
+  """store a resource in the companion pack, and write where it ended up"""
+  if packed_file is not None:
+    data_length = packed_file.size
+    write_contents = lambda pak_file: pak_file.write(memoryview(packed_file.data))
+  else:
+    data_length = os.path.getsize(source_path)
+    write_contents = lambda pak_file: copy_file_segment(source_path, pak_file, data_length)
+  
+  digest = bytes.fromhex(resource_digest(source_path, packed_file))
+  offset, length = resource_pack.add(bpy.path.basename(source_path), digest, data_length, write_contents)
+  
+  file.write(UINT16.pack(3))
+  file.write(PAK_REFERENCE.pack(offset, length, digest))
+
+
 def write_sound_resource_chunk(file, sound):
   # write chunk
   ptr = create_chunk(file, "RSRC", 1, get_uuid())
   
   # get absolute path to the sound to use for later
   sound_realpath = bpy.path.abspath(sound.filepath)
-  if export_options["EMBED_RESOURCES"]:
+  if export_options["EMBED_RESOURCES"] or resource_pack is not None:
     # write basename path if we're embedding textures, source path is useless
     write_string(file, bpy.path.basename(sound_realpath))
   else:
@@ -246,29 +376,15 @@ def write_sound_resource_chunk(file, sound):
   sound_extension = sound.filepath[-3:].upper() + " "
   file.write(sound_extension.encode('ascii'))
   
-  file.write(struct.pack("<H", 0)) # reserved
+  file.write(UINT16.pack(0)) # reserved
   
   # embed?
-  file.write(struct.pack("<H", (1 if export_options["EMBED_RESOURCES"] else 0)))
   if export_options["EMBED_RESOURCES"]:
-    # get our image binary  data
-    sound_data = None
-    
-    if sound.packed_file is not None:
-      sound_data = texture.image.packed_file.data
-    else:
-      sound_file = open(sound_realpath, "rb")
-      sound_data = sound_file.read()
-      sound_file.close()
-    
-    # write it
-    sound_len = len(sound_data)
-    file.write(struct.pack("<I", sound_len))
-    file.write(sound_data)
-    
-    # add padding if we need it
-    if sound_len % 2 > 0:
-      file.write("\x00".encode("ascii"))
+    write_embedded_resource(file, sound_realpath, sound.packed_file)
+  elif resource_pack is not None:
+    write_packed_resource(file, sound_realpath, sound.packed_file)
+  else:
+    file.write(UINT16.pack(0))
   
   close_chunk(file, ptr)
   
@@ -276,17 +392,17 @@ def write_speaker_chunk(file, speaker):
   # write chunk
   ptr = create_chunk(file, "AUDS", 1, get_uuid())
   
-  file.write(struct.pack("<fff", speaker.volume, speaker.pitch, speaker.attenuation))
-  file.write(struct.pack("<ff", speaker.volume_min, speaker.volume_max))
-  file.write(struct.pack("<ff", speaker.distance_reference, speaker.distance_max))
-  file.write(struct.pack("<ff", speaker.cone_angle_outer, speaker.cone_angle_inner))
+  file.write(VEC3.pack(speaker.volume, speaker.pitch, speaker.attenuation))
+  file.write(VEC2.pack(speaker.volume_min, speaker.volume_max))
+  file.write(VEC2.pack(speaker.distance_reference, speaker.distance_max))
+  file.write(VEC2.pack(speaker.cone_angle_outer, speaker.cone_angle_inner))
   
-  file.write(struct.pack("<H", (1 if speaker.muted else 0)))
+  file.write(UINT16.pack((1 if speaker.muted else 0)))
     
   if speaker.sound is not None:
-    file.write(struct.pack("<I", sound_map[speaker.sound.name]))
+    file.write(UINT32.pack(sound_map[speaker.sound.name]))
   else:
-    file.write(struct.pack("<i", -1))
+    file.write(INT32.pack(-1))
   
   close_chunk(file, ptr)
   
@@ -296,21 +412,21 @@ def write_scene_chunk(file, world):
   
   write_string(file, world.name)
   
-  file.write(struct.pack("<ffff", world.ambient_color[0], world.ambient_color[1], world.ambient_color[2], 1.0)) #ambient
-  file.write(struct.pack("<ffff", world.zenith_color[0], world.zenith_color[1], world.zenith_color[2], 1.0)) #sky
-  file.write(struct.pack("<ffff", world.horizon_color[0], world.horizon_color[1], world.horizon_color[2], 1.0)) #horizon
+  file.write(VEC4.pack(world.ambient_color[0], world.ambient_color[1], world.ambient_color[2], 1.0)) #ambient
+  file.write(VEC4.pack(world.zenith_color[0], world.zenith_color[1], world.zenith_color[2], 1.0)) #sky
+  file.write(VEC4.pack(world.horizon_color[0], world.horizon_color[1], world.horizon_color[2], 1.0)) #horizon
   
   # write fog only if enabled
-  file.write(struct.pack("<H", (1 if world.mist_settings.use_mist else 0)))
+  file.write(UINT16.pack((1 if world.mist_settings.use_mist else 0)))
   if world.mist_settings.use_mist:
-    file.write(struct.pack("<ffff", world.horizon_color[0], world.horizon_color[1], world.horizon_color[2], 1.0)) #fog
+    file.write(VEC4.pack(world.horizon_color[0], world.horizon_color[1], world.horizon_color[2], 1.0)) #fog
     
-    file.write(struct.pack("<ffff", world.mist_settings.intensity, 
-                                   world.mist_settings.start, 
-                                   world.mist_settings.depth, 
-                                   world.mist_settings.height))
+    file.write(VEC4.pack(world.mist_settings.intensity, 
+                         world.mist_settings.start, 
+                         world.mist_settings.depth, 
+                         world.mist_settings.height))
                                    
-    file.write(struct.pack("<H", (1 if world.mist_settings.falloff == 'QUADRATIC' else 0))) #type
+    file.write(UINT16.pack((1 if world.mist_settings.falloff == 'QUADRATIC' else 0))) #type
   
   close_chunk(file, ptr)
   
@@ -323,15 +439,13 @@ def write_object_chunk(file, ob):
   
   write_string(file, ob.name)
   rotation_radians = ob.matrix_world.to_euler()
-  file.write(struct.pack("<fff", *ob.matrix_local.to_translation()))
-  file.write(struct.pack("<fff", math.degrees(rotation_radians[0]), math.degrees(rotation_radians[1]), math.degrees(rotation_radians[2])))
-  file.write(struct.pack("<fff", *ob.scale))
+  translation = ob.matrix_local.to_translation()
+  file.write(OBJECT_TRANSFORM.pack(translation[0], translation[1], translation[2],
+                                   math.degrees(rotation_radians[0]), math.degrees(rotation_radians[1]), math.degrees(rotation_radians[2]),
+                                   ob.scale[0], ob.scale[1], ob.scale[2]))
   
-  # write parent
-  if ob.parent is not None:
-    file.write(struct.pack("<I", object_map[ob.parent.name]))
-  else:
-    file.write(struct.pack("<I", 0))
+  # get parent
+  parent_id = object_map[ob.parent.name] if ob.parent is not None else 0
     
   # create layer mask
   layer_mask = 0
@@ -339,10 +453,8 @@ def write_object_chunk(file, ob):
     if ob.layers[layer_num]:
       layer_mask |= (1<<layer_num)
       
-  file.write(struct.pack("<I", layer_mask))
-  
-  # wrtie visible state and selected state
-  file.write(struct.pack("<HH", (1 if ob.is_visible(bpy.context.scene) else 0), (1 if ob.select else 0)))
+  # write parent, layer mask, visible state and selected state
+  file.write(OBJECT_STATE.pack(parent_id, layer_mask, (1 if ob.is_visible(bpy.context.scene) else 0), (1 if ob.select else 0)))
   
   # write datablocks
   datablock_count = 0
@@ -351,9 +463,11 @@ def write_object_chunk(file, ob):
   if ob.rigid_body is not None: datablock_count += 2
   if ob.rigid_body_constraint is not None and verify_constraint_type(ob.rigid_body_constraint): datablock_count += 1
   if len(ob.vertex_groups) > 0: datablock_count += len(ob.vertex_groups)
+  if ob.name in skin_map: datablock_count += 1
   if len(ob.keys()) > 0: datablock_count += 1
   if ob.animation_data is not None and ob.animation_data.action is not None: datablock_count += 1
   if ob.type == 'CURVE': datablock_count += len(ob.data.splines)
+  if ob.type == 'MESH': datablock_count += len(lod_map.get(ob.data.name, []))
   
   # gather material datablocks
   material_datablock_ids = []
@@ -362,16 +476,16 @@ def write_object_chunk(file, ob):
       datablock_count += 1
       material_datablock_ids.append(material_map[ms.material.name])
   
-  file.write(struct.pack("<H", datablock_count)) #datablock count
+  file.write(UINT16.pack(datablock_count)) #datablock count
   
   # write material datablocks
   for matid in material_datablock_ids:
-    file.write(struct.pack("<I", matid))
+    file.write(UINT32.pack(matid))
   
   # write modifier datablocks
   if export_options["MODIFIER_MODE"] == 'preserve':
     for mod in ob.modifiers:
-      file.write(struct.pack("<I", modifier_map[ob.name + "_" + mod.name]))
+      file.write(UINT32.pack(modifier_map[ob.name + "_" + mod.name]))
   
   # write "concrete" datablock
   map = None
@@ -387,32 +501,41 @@ def write_object_chunk(file, ob):
     map = armature_map
   
   if map is not None:
-    file.write(struct.pack("<I", map[ob.data.name]))
+    file.write(UINT32.pack(map[ob.data.name]))
+  
+  # write lod datablocks, highest detail first
+  if ob.type == 'MESH':
+    for lod_id in lod_map.get(ob.data.name, []):
+      file.write(UINT32.pack(lod_id))
   
   # write rigidbody datablock
   if ob.rigid_body is not None:
     if ob.rigid_body_constraint is not None and  verify_constraint_type(ob.rigid_body_constraint):
-      file.write(struct.pack("<I", rigidbody_map[ob.name] - 2)) # constraint chunk written 2  chunks prior
-    file.write(struct.pack("<I", rigidbody_map[ob.name] - 1)) # collision chunk written prior
-    file.write(struct.pack("<I", rigidbody_map[ob.name]))
+      file.write(UINT32.pack(rigidbody_map[ob.name] - 2)) # constraint chunk written 2  chunks prior
+    file.write(UINT32.pack(rigidbody_map[ob.name] - 1)) # collision chunk written prior
+    file.write(UINT32.pack(rigidbody_map[ob.name]))
     
   # write spline datablocks
   if ob.type == 'CURVE':
-    for cspline in len(ob.data.splines):
-      file.write(struct.pack("<I", curve_map[ob.data.name + "_SCN_EXPORT_ID_" + str(cspline)]))
+    for cspline in range(len(ob.data.splines)):
+      file.write(UINT32.pack(curve_map[ob.data.name + "_SCN_EXPORT_ID_" + str(cspline)]))
   
   # write vertex_group datablock
   if len(ob.vertex_groups) > 0:
     for group in ob.vertex_groups:
-      file.write(struct.pack("<I", vertex_group_map[group.name]))
+      file.write(UINT32.pack(vertex_group_map[group.name]))
+  
+  # write skin datablock
+  if ob.name in skin_map:
+    file.write(UINT32.pack(skin_map[ob.name]))
   
   # write animation datablock
   if ob.animation_data is not None and ob.animation_data.action is not None: 
-    file.write(struct.pack("<I", action_map[ob.animation_data.action.name]))
+    file.write(UINT32.pack(action_map[ob.animation_data.action.name]))
     
   # write user data datablock
   if len(ob.keys()) > 0:
-    file.write(struct.pack("<I", userdata_map[ob.name]))
+    file.write(UINT32.pack(userdata_map[ob.name]))
   
   # close chunk
   close_chunk(file, ptr)
@@ -421,34 +544,34 @@ def write_camera_chunk(file, camera):
   # write chunk
   ptr = create_chunk(file, "CAMR", 1, get_uuid())
   
-  file.write(struct.pack("<H", (0 if camera.type == 'ORTHO' else 1)))
-  file.write(struct.pack("<ff", camera.clip_start, camera.clip_end))
+  file.write(UINT16.pack((0 if camera.type == 'ORTHO' else 1)))
+  file.write(VEC2.pack(camera.clip_start, camera.clip_end))
   
   aspect_ratio = camera.sensor_width / camera.sensor_height
-  file.write(struct.pack("<f", aspect_ratio))
+  file.write(FLOAT.pack(aspect_ratio))
   
-  file.write(struct.pack("<ff", camera.shift_x, camera.shift_y))
+  file.write(VEC2.pack(camera.shift_x, camera.shift_y))
   
-  file.write(struct.pack("<f", camera.sensor_width))
+  file.write(FLOAT.pack(camera.sensor_width))
   
   # write DOF settings
   dof_enabled = (camera.dof_distance > 0 or camera.dof_object is not None)
-  file.write(struct.pack("<H", (1 if dof_enabled else 0)))
+  file.write(UINT16.pack((1 if dof_enabled else 0)))
   
   if dof_enabled:
     if camera.dof_object is None:
-      file.write(struct.pack("<i", -1))
+      file.write(INT32.pack(-1))
     else:
-      file.write(struct.pack("<i", object_map[camera.dof_object.name]))
+      file.write(INT32.pack(object_map[camera.dof_object.name]))
       
-    file.write(struct.pack("<ff", camera.dof_distance, camera.gpu_dof.fstop))
+    file.write(VEC2.pack(camera.dof_distance, camera.gpu_dof.fstop))
   
   # write FOV / ortho size
   if camera.type == 'ORTHO':
-    file.write(struct.pack("<f", camera.ortho_scale))
+    file.write(FLOAT.pack(camera.ortho_scale))
   else:
     real_fov = (camera.angle / 3.01675) * 172.847
-    file.write(struct.pack("<f", real_fov))
+    file.write(FLOAT.pack(real_fov))
     
   close_chunk(file, ptr)
 
@@ -461,7 +584,7 @@ def write_texture_resource_chunk(file, texture):
   if texture.type == 'IMAGE' and texture.image is not None:
     # get absolute path to the image to use for later
     image_realpath = bpy.path.abspath(texture.image.filepath)
-    if export_options["EMBED_RESOURCES"]:
+    if export_options["EMBED_RESOURCES"] or resource_pack is not None:
       # write basename path if we're embedding textures, source path is useless
       write_string(file, bpy.path.basename(image_realpath))
     else:
@@ -480,35 +603,21 @@ def write_texture_resource_chunk(file, texture):
     else:
       file.write(truncate_format_string(texture.image.file_format).encode('ascii'))
     
-    file.write(struct.pack("<H", texture.image.depth)) # reserved, in this case : depth
+    file.write(UINT16.pack(texture.image.depth)) # reserved, in this case : depth
     
     # embed?
-    file.write(struct.pack("<H", (1 if export_options["EMBED_RESOURCES"] else 0)))
     if export_options["EMBED_RESOURCES"]:
-      # get our image binary  data
-      image_data = None
-      
-      if texture.image.packed_file is not None:
-        image_data = texture.image.packed_file.data
-      else:
-        image_file = open(image_realpath, "rb")
-        image_data = image_file.read()
-        image_file.close()
-      
-      # write it
-      image_len = len(image_data)
-      file.write(struct.pack("<I", image_len))
-      file.write(image_data)
-      
-      # add padding if we need it
-      if image_len % 2 > 0:
-        file.write("\x00".encode("ascii"))
+      write_embedded_resource(file, image_realpath, texture.image.packed_file)
+    elif resource_pack is not None:
+      write_packed_resource(file, image_realpath, texture.image.packed_file)
+    else:
+      file.write(UINT16.pack(0))
       
     
   else:
     write_string(file, "null")
     file.write("null".encode("ascii"))
-    file.write(struct.pack("<HH", 0, 0))
+    file.write(UINT16_PAIR.pack(0, 0))
   
   close_chunk(file, ptr)
   
@@ -532,26 +641,22 @@ def write_material_chunk(file, material):
   specular_hardness = (material.specular_hardness - 1) / 511
   
   # write rest
-  file.write(struct.pack("<ffff", *diffuse_color))
-  file.write(struct.pack("<ffff", *specular_color))
-  file.write(struct.pack("<ffff", 0.0, 0.0, 0.0, 1.0))
-  file.write(struct.pack("<ffff", 0.0, 0.0, 0.0, 1.0))
+  file.write(MATERIAL_COLORS.pack(*(diffuse_color + specular_color + [0.0, 0.0, 0.0, 1.0] + [0.0, 0.0, 0.0, 1.0])))
   
-  file.write(struct.pack("<f", specular_hardness))
-  file.write(struct.pack("<f", material.ambient))
+  file.write(FLOAT.pack(specular_hardness))
+  file.write(FLOAT.pack(material.ambient))
   
   # full emission if shadeless
   if material.use_shadeless:
-    file.write(struct.pack("<f", 1.0))
+    file.write(FLOAT.pack(1.0))
   else:
-    file.write(struct.pack("<f", material.emit))
+    file.write(FLOAT.pack(material.emit))
     
-  file.write(struct.pack("<f", material.specular_ior))
+  file.write(FLOAT.pack(material.specular_ior))
   
-  # write textures
+  # write textures, the count goes first so gather them aside
   num_textures = 0
-  texture_ptr = file.tell()
-  file.write(struct.pack("<I", 0))
+  texture_refs = io.BytesIO()
   
   for slot in material.texture_slots:
     if slot is not None and slot.texture is not None and slot.use:
@@ -561,217 +666,106 @@ def write_material_chunk(file, material):
       # write stuff about this texture (TODO: clean)
       # TODO: REALLY CLEAN, It's gotten worse
       if slot.use_map_color_diffuse:
-        write_texture_reference(file, slot.texture, 0, slot.diffuse_color_factor, blend_mode, slot.offset, slot.scale) #diffuse.color
+        write_texture_reference(texture_refs, slot.texture, 0, slot.diffuse_color_factor, blend_mode, slot.offset, slot.scale) #diffuse.color
         num_textures += 1
       if slot.use_map_diffuse:
-        write_texture_reference(file, slot.texture, 1, slot.diffuse_factor, blend_mode, slot.offset, slot.scale) #diffuse.intensity
+        write_texture_reference(texture_refs, slot.texture, 1, slot.diffuse_factor, blend_mode, slot.offset, slot.scale) #diffuse.intensity
         num_textures += 1
       if slot.use_map_color_spec:
-        write_texture_reference(file, slot.texture, 2, slot.specular_color_factor, blend_mode, slot.offset, slot.scale) #specular.color
+        write_texture_reference(texture_refs, slot.texture, 2, slot.specular_color_factor, blend_mode, slot.offset, slot.scale) #specular.color
         num_textures += 1
       if slot.use_map_specular:
-        write_texture_reference(file, slot.texture, 3, slot.specular_factor, blend_mode, slot.offset, slot.scale) #specular.intensity
+        write_texture_reference(texture_refs, slot.texture, 3, slot.specular_factor, blend_mode, slot.offset, slot.scale) #specular.intensity
         num_textures += 1
       if slot.use_map_hardness:
-        write_texture_reference(file, slot.texture, 4, slot.hardness_factor, blend_mode, slot.offset, slot.scale) #specular.hardness
+        write_texture_reference(texture_refs, slot.texture, 4, slot.hardness_factor, blend_mode, slot.offset, slot.scale) #specular.hardness
         num_textures += 1
       if slot.use_map_displacement:
-        write_texture_reference(file, slot.texture, 6, slot.displacement_factor, blend_mode, slot.offset, slot.scale) #displacement
+        write_texture_reference(texture_refs, slot.texture, 6, slot.displacement_factor, blend_mode, slot.offset, slot.scale) #displacement
         num_textures += 1
       if slot.use_map_ambient:
-        write_texture_reference(file, slot.texture, 8, slot.ambient_factor, blend_mode, slot.offset, slot.scale) #ambient
+        write_texture_reference(texture_refs, slot.texture, 8, slot.ambient_factor, blend_mode, slot.offset, slot.scale) #ambient
         num_textures += 1
       if slot.use_map_translucency or slot.use_map_alpha:
-        write_texture_reference(file, slot.texture, 7, (slot.translucency_factor if slot.use_map_translucency else slot.alpha_factor), blend_mode, slot.offset, slot.scale) #translucency
+        write_texture_reference(texture_refs, slot.texture, 7, (slot.translucency_factor if slot.use_map_translucency else slot.alpha_factor), blend_mode, slot.offset, slot.scale) #translucency
         num_textures += 1
       if slot.use_map_normal:
-        write_texture_reference(file, slot.texture, 12, slot.normal_factor, blend_mode, slot.offset, slot.scale) #normalmap
+        write_texture_reference(texture_refs, slot.texture, 12, slot.normal_factor, blend_mode, slot.offset, slot.scale) #normalmap
         num_textures += 1
       if slot.use_map_emit:
-        write_texture_reference(file, slot.texture, 9, slot.emit_factor, blend_mode, slot.offset, slot.scale) #emission
+        write_texture_reference(texture_refs, slot.texture, 9, slot.emit_factor, blend_mode, slot.offset, slot.scale) #emission
         num_textures += 1  
   
-  # go back and write num textures
-  file.seek(texture_ptr)
-  file.write(struct.pack("<I", num_textures))
-  file.seek(0, 2)
+  # write num textures, then the textures
+  file.write(UINT32.pack(num_textures))
+  file.write(texture_refs.getvalue())
   
   close_chunk(file, ptr)
   
-def write_mesh_chunk(file, mesh):
-  # write chunk
-  ptr = create_chunk(file, "MESH", 3, get_uuid())
-  
-  write_string(file, mesh.name)
-  
-  # write mesh info
-  file.write(struct.pack("<H", (1 if mesh.use_auto_smooth else 0)))
-  file.write(struct.pack("<H", (1 if len(mesh.vertices) <= 65535 else 0)))
-  
-  # write bounding box
-  bbox_min, bbox_max, bbox_center = bounds(mesh)
-  file.write(struct.pack("<fff", *bbox_min))
-  file.write(struct.pack("<fff", *bbox_max))
-  file.write(struct.pack("<fff", *bbox_center))
+def write_mesh_chunk(file, mesh, payloads=None):
+  # encode here if it wasn't done ahead of time
+  if payloads is None:
+    for encoded_mesh, payloads in encode_meshes([mesh]):
+      pass
   
-  # load up bmesh data
-  bm = bmesh.new()
+  # compact vertex streams need MESH v4
+  version = 4 if export_options["VERTEX_ENCODING"] == 'compact' else 3
   
-  # use mesh with modifiers applied if we only have one user & the export option was set
-  if mesh.users == 1 and export_options["MODIFIER_MODE"] == 'apply':
-    # find our parent owner
-    for ob in bpy.data.objects:
-      if ob.type == 'MESH' and ob.data.name == mesh.name:
-        bm.from_mesh(ob.to_mesh(bpy.context.scene, apply_modifiers = True, settings='PREVIEW'))
+  # write chunk
+  ptr = create_chunk(file, "MESH", version, get_uuid(), spool=("STREAM" in payloads))
+  counts = mesh_counts_map.get(mesh.name, {}).get("MESH")
+  if counts is not None:
+    set_chunk_hints(file, vertices=counts[0], indices=counts[1])
+  if "STREAM" in payloads:
+    # encode a slice at a time, straight into the file
+    data, stats = payloads["STREAM"]
+    slice_bytes = max(export_options["STREAM_BUDGET"] * 1024 * 1024 // 8, 1)
+    encode_mesh_data(file, data, stats, export_options["VERTEX_ENCODING"] == 'compact', slice_bytes)
   else:
-    bm.from_mesh(mesh)
-  
-  # get edge crease layer
-  crease_layer = bm.edges.layers.crease.verify()
-  
-  # log edges we want to export
-  # we do this so we don't have to loop the edge table
-  # several times
-  export_edges = []
-  edge_index_remap = {}
-  for edge in bm.edges:
-    crease = edge[crease_layer]
-    if not edge.smooth or edge.seam or crease > 0:
-      edge_index_remap[edge.index] = len(export_edges)
-      export_edges.append(edge)
-      
-  # gather tag list
-  tag_list = []
-  for edge in export_edges:
-    if not edge.smooth and not "SHARP" in tag_list:
-      tag_list.append("SHARP")
-    if edge.seam and not "SEAM" in tag_list:
-      tag_list.append("SEAM")
-  
-  # write tag list
-  file.write(struct.pack("<H", len(tag_list)))
-  for tag in tag_list:
-    write_string(file, tag)
-  
-  # write and gather color and uv layers
-  file.write(struct.pack("<HH", len(mesh.uv_layers), len(mesh.vertex_colors)))
-  bm_uv_layers = []
-  bm_vc_layers = []
+    file.write(payloads["MESH"])
+  close_chunk(file, ptr)
+
+
+def write_vertex_buffer_chunk(file, mesh_id, payload, counts=None):
+  # write chunk
+  ptr = create_chunk(file, "VBUF", 1, get_uuid())
+  if counts is not None:
+    set_chunk_hints(file, vertices=counts[0], indices=counts[1])
   
-  for uv_layer in mesh.uv_layers:
-    write_string(file, uv_layer.name)
-    file.write(struct.pack("<H", (1 if mesh.uv_layers.active.name == uv_layer.name else 0)))
-    bm_uv_layers.append(bm.loops.layers.uv.get(uv_layer.name))
-    
-  for vc_layer in mesh.vertex_colors:
-    write_string(file, vc_layer.name)
-    file.write(struct.pack("<H", (1 if vc_layer.active_render else 0)))
-    bm_vc_layers.append(bm.loops.layers.color.get(vc_layer.name))
-  
-  
-  # gather tag links
-  tag_links = []
-  
-  for edge in export_edges:
-    if not edge.smooth:
-      tag_links.append((1, tag_list.index("SHARP"), edge_index_remap[edge.index]))
-    if edge.seam:
-      tag_links.append((1, tag_list.index("SEAM"), edge_index_remap[edge.index]))
-  
-  # write  tag links (but get some important data first!)
-  num_verts = len(bm.verts)
-  compact_indices = (num_verts <= 65535) # if we have less than 65535 verts, use short instead of long  
-  
-  file.write(struct.pack("<I", len(tag_links)))
-  for link in tag_links:
-    file.write(struct.pack("<HH", link[0], link[1])) #type, ID
-    file.write(struct.pack(("H" if compact_indices else "I"), link[2])) # index in list of vert/edge/face
-    
-  
-  # write geometry
-  file.write(struct.pack("<III", num_verts, len(export_edges), max(len(mesh.materials), 1)))
-  for vert in bm.verts:
-    file.write(struct.pack("<fff", vert.co[0], vert.co[1], vert.co[2]))
-    file.write(struct.pack("<fff", vert.normal[0], vert.normal[1], vert.normal[2]))
-  
-  for edge in export_edges:
-    file.write(struct.pack(("HH" if compact_indices else "II"), edge.verts[0].index, edge.verts[1].index))
-    file.write(struct.pack("<f", crease))
-  
-  # gather num faces on each mat
-  num_materials = max(len(mesh.materials), 1)
-  face_counts = [0] * num_materials
-  for face in bm.faces:
-    face_counts[max(face.material_index, 0)] += 1
-  
-  # gather prim types (num sides) and build prim groups
-  max_prim = 0
-  for face in bm.faces:
-    num_sides = len(face.loops)
-    max_prim = max(num_sides, max_prim)
-  
-  # write FaceContainers
-  for mat_index in range(num_materials):
-    # find out how what kind of prims we need
-    prim_map = {}
-    for face in bm.faces:
-      # only grab faces for this material
-      if max(face.material_index, 0) != mat_index:
-        continue
-        
-      # get num sides and add to map if it's not there
-      num_sides = len(face.loops)
-      if not num_sides in prim_map:
-        prim_map[num_sides] = 1
-      else:
-        prim_map[num_sides] += 1
-    
-    #write facecontainer 
-    file.write(struct.pack("<H", len(prim_map)))
-    
-    # write primgroups
-    for key in prim_map:
-      file.write(struct.pack("<IH", prim_map[key], key))
-      
-      # write faces for prim group
-      for face in bm.faces:
-        # verify we're on the right mat
-        if max(face.material_index, 0) != mat_index or len(face.loops) != key:
-          continue
-        
-        # write face
-        for loop in face.loops:
-          file.write(struct.pack(("H" if compact_indices else "I"), loop.vert.index))
-          for uv_layer in bm_uv_layers:
-            uv_loop = loop[uv_layer]
-            file.write(struct.pack("<ff", uv_loop.uv[0], uv_loop.uv[1]))
-          for vc_layer in bm_vc_layers:
-            vc_loop = loop[vc_layer]
-            file.write(struct.pack("<ffff", vc_loop[0], vc_loop[1], vc_loop[2], 1.0))
-   
-  # release resources
-  bm.free()
+  # write the MESH this was built from
+  file.write(UINT32.pack(mesh_id))
+  file.write(payload)
   
   close_chunk(file, ptr)
 
 
 def write_collision_chunk(file, rigidbody):
-  # write chunk
-  ptr = create_chunk(file, "COLL", 1, get_uuid())
+  # write chunk, COLL v2 has real bounds where v1 always had a unit box
+  ptr = create_chunk(file, "COLL", 2, get_uuid())
   
   prim_type = rigidbody_shape_dict.get(rigidbody.collision_shape, 0)
-  file.write(struct.pack("<H", prim_type))
-  file.write(struct.pack("ffffff", 0, 0, 0, 1, 1, 1))
+  file.write(UINT16.pack(prim_type))
+  
+  # write center and half extents, taken from the mesh if there is one
+  rigidbody_parent = bpy.data.objects[rigidbody.id_data.name]
+  stats = None
+  if rigidbody_parent.type == 'MESH':
+    stats = mesh_stats_map.get(rigidbody_parent.data.name)
+  
+  if stats is not None:
+    half_extents = [(stats["bbox_max"][i] - stats["bbox_min"][i]) / 2 for i in range(3)]
+    file.write(COLLISION_BOUNDS.pack(*(stats["bbox_center"] + half_extents)))
+  else:
+    file.write(COLLISION_BOUNDS.pack(0, 0, 0, 1, 1, 1))
     
-  file.write(struct.pack("<ff", rigidbody.friction, rigidbody.restitution))
+  file.write(VEC2.pack(rigidbody.friction, rigidbody.restitution))
   
   # write mesh id if applicable
   if prim_type >= 5:
-    rigidbody_parent = bpy.data.objects[rigidbody.id_data.name]
     if rigidbody_parent.type == 'MESH':
-      file.write(struct.pack("<I", mesh_map[rigidbody_parent.data.name]))
+      file.write(UINT32.pack(mesh_map[rigidbody_parent.data.name]))
     else:
-      file.write(struct.pack("<i", -1))
+      file.write(INT32.pack(-1))
     
   close_chunk(file, ptr)
     
@@ -780,11 +774,11 @@ def write_rigidbody_chunk(file, rigidbody):
   # write chunk
   ptr = create_chunk(file, "RGDB", 1, get_uuid())
   
-  file.write(struct.pack("<fff", rigidbody.mass, 
-                                  rigidbody.linear_damping, 
-                                  rigidbody.angular_damping,))
-  
-  file.write(struct.pack("<HH", (1 if rigidbody.kinematic else 0), (1 if rigidbody.use_start_deactivated else 0)))
+  file.write(RIGIDBODY.pack(rigidbody.mass, 
+                            rigidbody.linear_damping, 
+                            rigidbody.angular_damping,
+                            (1 if rigidbody.kinematic else 0),
+                            (1 if rigidbody.use_start_deactivated else 0)))
   
   close_chunk(file, ptr)
   
@@ -792,82 +786,79 @@ def write_spline_chunk(file, resolution, spline):
   # write chunk
   ptr = create_chunk(file, "SPLN", 1, get_uuid())
   
-  #write spline point count
-  point_source = sub_spline.bezier_points if sub_spline.type == 'BEZIER' else sub_spline.points
-  file.write(struct.pack("<I", len(point_source)))
-  
-  # write segment count
-  file.write(struct.pack("<H", resolution))
-  
-  #write looped
-  file.write(struct.pack("<H", (1 if spline.use_cyclic_u else 0)))
+  point_source = spline.bezier_points if spline.type == 'BEZIER' else spline.points
   
   # get type and tilt type
   type = curve_type_dict.get(spline.type, 0)
   tilt_type = curve_tilt_dict.get(spline.tilt_interpolation, 0)
     
-  # write type and tilt type
-  file.write(struct.pack("<HH", type, tilt_type))
+  # write spline point count, segment count, looped, type and tilt type
+  file.write(SPLINE_HEADER.pack(len(point_source), resolution, (1 if spline.use_cyclic_u else 0), type, tilt_type))
   
-  for point in point_source:
-    file.write(struct.pack("<fff", point.co[0], point.co[1], point.co[2]))
-    file.write(struct.pack("<fff", point.radius, point.tilt, (point.weight if sub_spline.type != 'BEZIER' else 0.0)))
-    if sub_spline.type == 'BEZIER':
-      file.write(struct.pack("<fff", point.handle_left[0], point.handle_left[1], point.handle_left[2]))
-      file.write(struct.pack("<fff", point.handle_right[0], point.handle_right[1], point.handle_right[2]))
+  # write points
+  if spline.type == 'BEZIER':
+    file.write(pack_records(BEZIER_POINT, [(point.co[0], point.co[1], point.co[2], point.radius, point.tilt, 0.0,
+                                            point.handle_left[0], point.handle_left[1], point.handle_left[2],
+                                            point.handle_right[0], point.handle_right[1], point.handle_right[2]) for point in point_source]))
+  else:
+    file.write(pack_records(SPLINE_POINT, [(point.co[0], point.co[1], point.co[2], point.radius, point.tilt, point.weight) for point in point_source]))
   
   
   close_chunk(file, ptr)
 
   
-def write_vertex_group_chunk(file, group, object):
+def gather_vertex_group_weights(object):
+    """collect the weights of every vertex group of an object in one pass over its vertices.
+    returns (sub_pairs, weights) per group index, sub pairs being runs of consecutive member
+    vertices and weights the weights of those members in order"""
+    num_groups = len(object.vertex_groups)
+    group_weights = [([], []) for group_index in range(num_groups)]
+    last_member = [-2] * num_groups
+    
+    for vert_index, vertex in enumerate(object.data.vertices):
+      for element in vertex.groups:
+        group_index = element.group
+        if group_index >= num_groups:
+          continue
+          
+        sub_pairs, weights = group_weights[group_index]
+        
+        # extend the current run, or start a new one after a gap
+        if last_member[group_index] == vert_index - 1:
+          sub_pairs[-1][1] = vert_index
+        else:
+          sub_pairs.append([vert_index, vert_index])
+          
+        last_member[group_index] = vert_index
+        weights.append(element.weight)
+        
+    return group_weights
+
+
+def write_vertex_group_chunk(file, group, object, group_weights=None):
+    # gather weights here if it wasn't done for the whole object
+    if group_weights is None:
+      group_weights = gather_vertex_group_weights(object)[group.index]
+    sub_pairs, weights = group_weights
+    
     # write chunk
     ptr = create_chunk(file, "VTXG", 1, get_uuid())
-    
-    num_vertices = len(object.data.vertices)
+    set_chunk_hints(file, vertices=len(weights))
     
     # write name
     write_string(file, group.name)
     active = (group.name == object.vertex_groups.active.name)
     
-    # calculate sub pairs for efficient storage
-    sub_pairs = []
-    
-    pair_start = 0
-    pair_end = 0
-    in_void = False
-    
-    # look through verts + 1 to cause an exeption on the last vert
-    # kinda hacky :D
-    for vert_index in range(num_vertices + 1):
-      try:
-        # hack since we have no exception for out of bounds :|
-        if vert_index == num_vertices:
-          raise Exception("Shieeet")
-          
-        group.weight(vert_index)
-        
-        # start a new pair if the last thing we did was get an exception
-        if in_void:
-          in_void = False
-          pair_start = vert_index
-          
-        pair_end = vert_index
-      except Exception:
-        if not in_void and pair_end != pair_start:
-          sub_pairs.append([pair_start, pair_end])
-          
-        in_void = True
-    
     # write the rest of the VertexGroup, then write the sub pairs
-    file.write(struct.pack("<HH", (1 if active else 0), len(sub_pairs)))
+    file.write(UINT16_PAIR.pack((1 if active else 0), len(sub_pairs)))
     
+    weights = numpy.array(weights, dtype="<f4")
+    weight_index = 0
     for pair in sub_pairs:
-      file.write(struct.pack("<II", *pair))
-      for vert_index in range(pair[0], pair[1] + 1):
-        file.write(struct.pack("<f", group.weight(vert_index)))
-      
-      
+      pair_length = pair[1] - pair[0] + 1
+      file.write(VERTEX_GROUP_RUN.pack(*pair))
+      file.write(weights[weight_index:weight_index + pair_length].tobytes())
+      weight_index += pair_length
     
     # close chunk
     close_chunk(file, ptr)    
@@ -875,11 +866,11 @@ def write_vertex_group_chunk(file, group, object):
 
 def write_constraint_info(file, constraint):
   # write constraint info
-  file.write(struct.pack("<HH", (0 if constraint.disable_collisions else 1), (1 if constraint.use_breaking else 0)))
+  file.write(CONSTRAINT_INFO.pack((0 if constraint.disable_collisions else 1), (1 if constraint.use_breaking else 0)))
   
   # write break threshold
   if constraint.use_breaking:
-    file.write(struct.pack("f", constraint.breaking_threshold))
+    file.write(FLOAT.pack(constraint.breaking_threshold))
     
 
 def write_spring_joint_chunk(file, constraint):
@@ -887,15 +878,15 @@ def write_spring_joint_chunk(file, constraint):
   
   # spring joint specific
   constraint_obj_id = -1 if constraint.object2 is None else object_map[constraint.object2.name]
-  file.write(struct.pack("<i", constraint_obj_id))
+  file.write(INT32.pack(constraint_obj_id))
   
-  file.write(struct.pack("fff", 0, 0, 0)) # local attachment point
+  file.write(VEC3.pack(0, 0, 0)) # local attachment point
   
   # compute avg spring damp and force
-  avg_spring_damp = (constraint.spring_damping_x, constraint.spring_damping_y, constraint.spring_damping_z) / 3
-  avg_spring_force = (constraint.spring_stiffness_x, constraint.spring_stiffness_y, constraint.spring_stiffness_z) / 3
+  avg_spring_damp = sum((constraint.spring_damping_x, constraint.spring_damping_y, constraint.spring_damping_z)) / 3.0
+  avg_spring_force = sum((constraint.spring_stiffness_x, constraint.spring_stiffness_y, constraint.spring_stiffness_z)) / 3.0
   
-  file.write(struct.pack("ff", avg_spring_force, avg_spring_damp))
+  file.write(VEC2.pack(avg_spring_force, avg_spring_damp))
   
   # write constraint shared info
   write_constraint_info(file, constraint)
@@ -907,7 +898,7 @@ def write_fixed_joint_chunk(file, constraint):
   
   # fixed joint specific
   constraint_obj_id = -1 if constraint.object2 is None else object_map[constraint.object2.name]
-  file.write(struct.pack("<i", constraint_obj_id))
+  file.write(INT32.pack(constraint_obj_id))
   
   # write constraint shared info
   write_constraint_info(file, constraint)
@@ -920,13 +911,13 @@ def write_hinge_joint_chunk(file, constraint):
   
   # hinge  joint specific
   constraint_obj_id = -1 if constraint.object2 is None else object_map[constraint.object2.name]
-  file.write(struct.pack("<i", constraint_obj_id))
+  file.write(INT32.pack(constraint_obj_id))
   
-  file.write(struct.pack("fff", 0, 0, 0)) # local attachment point
+  file.write(VEC3.pack(0, 0, 0)) # local attachment point
   
   # calculate rotation axis
   if constraint.object2 is None:
-    file.write(struct.pack("fff", 0, 0, 0)) # hinge axis, no reference to anything so 0,0,0
+    file.write(VEC3.pack(0, 0, 0)) # hinge axis, no reference to anything so 0,0,0
   else:
     parent_rotation = mathutils.Euler(constraint.object2.rotation_euler, 'XYZ').to_quaternion()
     rotation_axis = None
@@ -934,17 +925,17 @@ def write_hinge_joint_chunk(file, constraint):
       rotation_axis = parent_rotation * mathutils.Vector((0,0,1))
     elif constraint.type == 'MOTOR':
       rotation_axis = parent_rotation * mathutils.Vector((1,0,0))
-    file.write(struct.pack("fff", rotation_axis[0], rotation_axis[1], rotation_axis[2])) # hinge axis
+    file.write(VEC3.pack(rotation_axis[0], rotation_axis[1], rotation_axis[2])) # hinge axis
   
   # rotation limits
-  file.write(struct.pack("H", (1 if constraint.use_limit_ang_z else 0)))
+  file.write(UINT16.pack((1 if constraint.use_limit_ang_z else 0)))
   if constraint.use_limit_ang_z:
-    file.write(struct.pack("ff", math.degrees(constraint.limit_ang_z_lower), math.degrees(constraint.limit_ang_z_upper)))
+    file.write(VEC2.pack(math.degrees(constraint.limit_ang_z_lower), math.degrees(constraint.limit_ang_z_upper)))
   
   # motor specific
-  file.write(struct.pack("H", (1 if (constraint.type == 'MOTOR' and constraint.use_motor_ang) else 0)))
+  file.write(UINT16.pack((1 if (constraint.type == 'MOTOR' and constraint.use_motor_ang) else 0)))
   if constraint.type == 'MOTOR' and constraint.use_motor_ang:
-    file.write(struct.pack("ff", constraint.motor_ang_target_velocity, constraint.motor_ang_max_impulse))
+    file.write(VEC2.pack(constraint.motor_ang_target_velocity, constraint.motor_ang_max_impulse))
   
   # write constraint shared info
   write_constraint_info(file, constraint)
@@ -961,14 +952,250 @@ def write_constraint_chunk(file, constraint):
     write_fixed_joint_chunk(file, constraint)
 
     
+def write_toc_chunk(file):
+  """list every chunk written so far, followed by the fixed footer pointing at this list"""
+  toc_offset = file.tell()
+  entries = list(file.toc)
+  
+  ptr = create_chunk(file, "TOC ", 1, get_uuid())
+  file.write(UINT32.pack(len(entries)))
+  file.write(pack_records(TOC_ENTRY, [(id, type.encode("ascii"), version, flags, offset, size, vertices, indices, keys)
+                                      for id, type, version, flags, offset, size, vertices, indices, keys in entries]))
+  close_chunk(file, ptr)
+  
+  # a plain RIFF chunk, readers that don't know it skip it
+  file.write(b"TOCP" + UINT32.pack(8) + UINT64.pack(toc_offset))
+
+
 def write_file_chunk(file):
   ptr = create_chunk(file, "FILE", 1, get_uuid())
   
-  file.write(struct.pack("<H",1)) # feature set 1
+  file.write(UINT16.pack(1)) # feature set 1
   
   close_chunk(file, ptr)
   
 
+KEYFRAME_RECORD = numpy.dtype([("time", "<f4"), ("in_tangent", "<f4"), ("out_tangent", "<f4"), ("interpolation", "<u2"), ("value", "<f4")])
+
+def angle2d_array(p1, p2):
+  """signed angle between the 2d points of two arrays, seen from the origin"""
+  return numpy.arctan2(p1[:, 0] * p2[:, 1] - p2[:, 0] * p1[:, 1], p1[:, 0] * p2[:, 0] + p1[:, 1] * p2[:, 1])
+
+
+def pack_keyframe_records(data_path, co, handle_left, handle_right, interpolation, frame_divisor):
+  """keys given as (frame, value) arrays packed into ANIM keyframe records"""
+  values = co[:, 1]
+  
+  # special case: convert from radians to degrees (I got it, I figured it out!)
+  if data_path == "rotation_euler":
+    values = numpy.degrees(values)
+  
+  # tangents are the angles between the key and its handles
+  records = numpy.empty(len(co), dtype=KEYFRAME_RECORD)
+  records["time"] = co[:, 0] / frame_divisor
+  records["in_tangent"] = angle2d_array(co, handle_left)
+  records["out_tangent"] = angle2d_array(co, handle_right)
+  records["interpolation"] = interpolation
+  records["value"] = values
+  return records
+
+
+def build_keyframe_records(curve, frame_divisor):
+  """all keyframes of a curve as packed ANIM keyframe records"""
+  keyframes = curve.keyframe_points
+  num_keyframes = len(keyframes)
+  
+  co = numpy.empty(num_keyframes * 2, dtype=numpy.float64)
+  handle_left = numpy.empty(num_keyframes * 2, dtype=numpy.float64)
+  handle_right = numpy.empty(num_keyframes * 2, dtype=numpy.float64)
+  keyframes.foreach_get("co", co)
+  keyframes.foreach_get("handle_left", handle_left)
+  keyframes.foreach_get("handle_right", handle_right)
+  co.shape = handle_left.shape = handle_right.shape = (num_keyframes, 2)
+  
+  # the key value is what the curve evaluates to, unless modifiers change it
+  if len(curve.modifiers) > 0:
+    co[:, 1] = [curve.evaluate(time) for time in co[:, 0]]
+  
+  interpolation = [(0 if kf.interpolation == 'CONSTANT' else 2) for kf in keyframes]
+  return pack_keyframe_records(curve.data_path, co, handle_left, handle_right, interpolation, frame_divisor)
+
+
+def bake_keyframe_records(data_path, frames, values, frame_divisor):
+  """samples taken at evenly spaced frames as ANIM keyframe records"""
+  co = numpy.empty((len(frames), 2), dtype=numpy.float64)
+  co[:, 0] = frames
+  co[:, 1] = values
+  frame_step = frames[1] - frames[0] if len(frames) > 1 else 1.0
+  
+  # give every sample handles along the local slope, a third of the way to its neighbours
+  if len(frames) > 1:
+    slope = numpy.gradient(co[:, 1], frame_step)
+  else:
+    slope = numpy.zeros(len(frames))
+  handle_offset = numpy.empty_like(co)
+  handle_offset[:, 0] = frame_step / 3.0
+  handle_offset[:, 1] = slope * (frame_step / 3.0)
+  
+  return pack_keyframe_records(data_path, co, co - handle_offset, co + handle_offset, 2, frame_divisor)
+
+
+def get_constrained_bones(anim):
+  """pose bones with active constraints on armatures playing this action,
+  as {bone name: (armature object, pose bone)}"""
+  constrained = {}
+  for ob in bpy.data.objects:
+    if ob.type != 'ARMATURE' or ob.animation_data is None or ob.animation_data.action != anim:
+      continue
+    for pose_bone in ob.pose.bones:
+      if any(not constraint.mute and constraint.influence > 0 for constraint in pose_bone.constraints):
+        constrained[pose_bone.name] = (ob, pose_bone)
+  return constrained
+
+
+def get_pose_basis(pose_bone):
+  """evaluated pose of a bone relative to its rest pose, constraints included"""
+  bone = pose_bone.bone
+  if pose_bone.parent is not None:
+    rest = bone.parent.matrix_local.inverted_safe() * bone.matrix_local
+    pose = pose_bone.parent.matrix.inverted_safe() * pose_bone.matrix
+  else:
+    rest = bone.matrix_local
+    pose = pose_bone.matrix
+  return rest.inverted_safe() * pose
+
+
+def bake_constrained_bones(constrained, frames):
+  """step the scene through the frames once, sampling the transforms of all
+  constrained bones. returns tracks as (data path, array index, values)"""
+  scene = bpy.context.scene
+  original_frame = (scene.frame_current, scene.frame_subframe)
+  samples = {bone_name : [] for bone_name in constrained}
+  
+  try:
+    for frame in frames:
+      whole_frame = int(math.floor(frame))
+      scene.frame_set(whole_frame, subframe=frame - whole_frame)
+      for bone_name, (ob, pose_bone) in constrained.items():
+        samples[bone_name].append(get_pose_basis(pose_bone).decompose())
+  finally:
+    scene.frame_set(original_frame[0], subframe=original_frame[1])
+  
+  tracks = []
+  for bone_name, (ob, pose_bone) in constrained.items():
+    base_path = 'pose.bones["%s"].' % bone_name
+    locations = [sample[0] for sample in samples[bone_name]]
+    scales = [sample[2] for sample in samples[bone_name]]
+    
+    # keep the rotation mode of the bone, rotations stay continuous across frames
+    if pose_bone.rotation_mode in ('QUATERNION', 'AXIS_ANGLE'):
+      rotation_path = "rotation_quaternion"
+      rotations = []
+      for sample in samples[bone_name]:
+        # q and -q are the same rotation, keep the one closest to the previous frame
+        if len(rotations) > 0:
+          sample[1].make_compatible(rotations[-1])
+        rotations.append(sample[1])
+    else:
+      rotation_path = "rotation_euler"
+      rotations = []
+      for sample in samples[bone_name]:
+        if len(rotations) > 0:
+          rotations.append(sample[1].to_euler(pose_bone.rotation_mode, rotations[-1]))
+        else:
+          rotations.append(sample[1].to_euler(pose_bone.rotation_mode))
+    
+    for property_name, values in (("location", locations), (rotation_path, rotations), ("scale", scales)):
+      for array_index in range(len(values[0])):
+        tracks.append((base_path + property_name, array_index, [value[array_index] for value in values]))
+  
+  return tracks
+
+
+def sample_action_tracks(anim, frames):
+  """bake every curve of an action at the given frames, as (data path, array index, values).
+  curves are evaluated directly, the scene is only stepped through when constraints move bones"""
+  constrained = get_constrained_bones(anim)
+  
+  tracks = []
+  for curve in anim.fcurves:
+    # constrained bone transforms come from the baked pose instead
+    if curve.data_path.startswith('pose.bones["'):
+      bone_name, property_name = curve.data_path[len('pose.bones["'):].split('"].', 1)
+      if bone_name in constrained and property_name in ("location", "rotation_quaternion", "rotation_euler", "rotation_axis_angle", "scale"):
+        continue
+    
+    tracks.append((curve.data_path, curve.array_index, [curve.evaluate(frame) for frame in frames]))
+  
+  if len(constrained) > 0:
+    tracks.extend(bake_constrained_bones(constrained, frames))
+  return tracks
+
+
+def reduce_keyframe_records(records, tolerance):
+  """drop keys that linear interpolation between their neighbours reproduces
+  within tolerance (Ramer-Douglas-Peucker, measuring the value error). keys
+  starting a span that lost keys become linear, which is what was measured"""
+  num_keyframes = len(records)
+  if num_keyframes < 3:
+    return records
+  
+  times = records["time"].astype(numpy.float64)
+  values = records["value"].astype(numpy.float64)
+  
+  # ends and constant steps always stay
+  keep = numpy.zeros(num_keyframes, dtype=numpy.bool_)
+  keep[0] = keep[-1] = True
+  constant = numpy.nonzero(records["interpolation"] == 0)[0]
+  keep[constant] = True
+  keep[numpy.minimum(constant + 1, num_keyframes - 1)] = True
+  
+  kept = numpy.nonzero(keep)[0]
+  segments = list(zip(kept[:-1], kept[1:]))
+  while len(segments) > 0:
+    first, last = segments.pop()
+    if last - first < 2:
+      continue
+    
+    span = times[last] - times[first]
+    inner_times = times[first + 1:last]
+    if span > 0:
+      fitted = values[first] + (values[last] - values[first]) * (inner_times - times[first]) / span
+    else:
+      fitted = numpy.full(len(inner_times), values[first])
+    
+    error = numpy.abs(values[first + 1:last] - fitted)
+    worst = int(numpy.argmax(error))
+    if error[worst] > tolerance:
+      split = first + 1 + worst
+      keep[split] = True
+      segments.append((first, split))
+      segments.append((split, last))
+  
+  reduced = records[keep]
+  kept = numpy.nonzero(keep)[0]
+  reduced["interpolation"][numpy.nonzero(numpy.diff(kept) > 1)[0]] = 1
+  return reduced
+
+
+def quantize_keyframe_records(records, bits):
+  """snap key times and values to 2^bits steps over the range of the curve,
+  keys landing on the same time are merged"""
+  steps = float((1 << bits) - 1)
+  
+  for field in ("time", "value"):
+    column = records[field].astype(numpy.float64)
+    if len(column) == 0:
+      continue
+    low = column.min()
+    extent = column.max() - low
+    if extent > 0:
+      records[field] = low + numpy.round((column - low) / extent * steps) * (extent / steps)
+  
+  unique_times, first_keys = numpy.unique(records["time"], return_index=True)
+  return records[numpy.sort(first_keys)]
+
+
 def write_anim_chunk(file, anim):
   ptr = create_chunk(file, "ANIM", 2, get_uuid())
   
@@ -977,47 +1204,51 @@ def write_anim_chunk(file, anim):
   
   # math
   frame_divisor = float(bpy.context.scene.render.fps)
+  keys_in = 0
+  keys_out = 0
+  
+  # gather keys for every curve, baked ones are sampled all at once
+  if export_options["ANIM_BAKE"]:
+    frame_step = frame_divisor / export_options["ANIM_BAKE_RATE"]
+    frames = numpy.arange(anim.frame_range[0], anim.frame_range[1] + frame_step * 0.5, frame_step, dtype=numpy.float64)
+    tracks = [(data_path, array_index, bake_keyframe_records(data_path, frames, values, frame_divisor))
+              for data_path, array_index, values in sample_action_tracks(anim, frames)]
+  else:
+    tracks = [(curve.data_path, curve.array_index, build_keyframe_records(curve, frame_divisor)) for curve in anim.fcurves]
   
   # write header
-  curve_count = len(anim.fcurves)
-  file.write(struct.pack("<ffI", 
-                         anim.frame_range[0] / frame_divisor, 
-                         anim.frame_range[1] / frame_divisor,
-                         curve_count))
+  curve_count = len(tracks)
+  file.write(ANIM_HEADER.pack(anim.frame_range[0] / frame_divisor, 
+                              anim.frame_range[1] / frame_divisor,
+                              curve_count))
   
   # write curves
-  for curve in anim.fcurves:
+  for curve_data_path, array_index, records in tracks:
     # make a data path like "location_0" etc, and use the translated result
-    data_path = translate_data_path(curve.data_path + ":" + str(curve.array_index))
+    data_path = translate_data_path(curve_data_path + ":" + str(array_index))
+    
+    # reduce the keys
+    keys_in += len(records)
     
-    # get animation data
-    keyframes = curve.keyframe_points
+    # quantize first, merging keys afterwards would break the reduction tolerance
+    if export_options["ANIM_QUANTIZE_BITS"] > 0:
+      records = quantize_keyframe_records(records, export_options["ANIM_QUANTIZE_BITS"])
+    if export_options["ANIM_TOLERANCE"] > 0:
+      records = reduce_keyframe_records(records, export_options["ANIM_TOLERANCE"])
+    keys_out += len(records)
     
     # write curve header
     write_string(file, data_path)
-    file.write(struct.pack("<H", 0)) # value type = 0 (float)
-    file.write(struct.pack("<I", len(keyframes))) # keyframes
+    file.write(UINT16.pack(0)) # value type = 0 (float)
+    file.write(UINT32.pack(len(records))) # keyframes
     # write keyframes
-    for kf in keyframes:
-      # calculate keyframe data
-      kf_time =  kf.co[0]
-      kf_value = curve.evaluate(kf_time)
-      kf_in_tangent = angle2d(kf.co, kf.handle_left)
-      kf_out_tangent = angle2d(kf.co, kf.handle_right)
-      
-      # get interpolation type
-      kf_interpolation_type = 1 # default to linear
-      if kf.interpolation == 'CONSTANT':
-        kf_interpolation_type = 0
-      else:
-        kf_interpolation_type = 2
-      
-      # special case: convert from radians to degrees (I got it, I figured it out!)
-      if curve.data_path == "rotation_euler":
-        kf_value = math.degrees(kf_value)
-      
-      # write keyframe data
-      file.write(struct.pack("<fffHf", kf_time / frame_divisor, kf_in_tangent, kf_out_tangent, kf_interpolation_type, kf_value))
+    file.write(records.tobytes())
+    
+  set_chunk_hints(file, keys=keys_out)
+  
+  # report what the reduction did
+  if keys_in != keys_out:
+    print("...reduced action %s from %d to %d keys (%.1f%%)" % (anim.name, keys_in, keys_out, 100.0 * keys_out / keys_in))
     
   # finish off
   close_chunk(file, ptr)
@@ -1026,10 +1257,11 @@ def write_armature_chunk(file, armature):
   ptr = create_chunk(file, "SKEL", 1, get_uuid())
   
   bone_map = {}
+  bone_maps[armature.name] = bone_map
   cur_bone_idx = 0
   
   # write num bones
-  file.write(struct.pack('<H', len(armature.bones)))
+  file.write(UINT16.pack(len(armature.bones)))
   
   # create bone map
   for bone in armature.bones:
@@ -1040,21 +1272,82 @@ def write_armature_chunk(file, armature):
   for bone in armature.bones:
     write_string(file, bone.name)
     
-    # write parent
-    if bone.parent is not None:
-      file.write(struct.pack('<h', bone_map[bone.parent.name]))
-    else:
-      file.write(struct.pack('<h', -1)) # root
+    # write parent, -1 for the root
+    parent_index = bone_map[bone.parent.name] if bone.parent is not None else -1
     
-    file.write(struct.pack("<fff", *bone.head_local))
-    file.write(struct.pack("<fff", *bone.tail_local))
-    file.write(struct.pack("<f", 0)) # TODO : USE EDIT BONE ROLL
+    head = bone.head_local
+    tail = bone.tail_local
+    file.write(BONE.pack(parent_index, head[0], head[1], head[2], tail[0], tail[1], tail[2], 0)) # TODO : USE EDIT BONE ROLL
     
   close_chunk(file, ptr)
+
+
+def write_skin_chunk(file, ob, armature_object):
+  armature = armature_object.data
+  bone_map = bone_maps[armature.name]
+  num_influences = export_options["SKIN_INFLUENCES"]
+  num_vertices = len(ob.data.vertices)
+  
+  # pick the heaviest bones of each vertex, groups without a bone don't deform anything
+  group_bones = {group.index : bone_map[group.name] for group in ob.vertex_groups if group.name in bone_map}
+  bone_indices = numpy.zeros((num_vertices, num_influences), dtype=numpy.uint16)
+  bone_weights = numpy.zeros((num_vertices, num_influences), dtype=numpy.float32)
+  
+  for vert_index, vertex in enumerate(ob.data.vertices):
+    influences = [(element.weight, group_bones[element.group]) for element in vertex.groups if element.group in group_bones and element.weight > 0]
+    influences.sort(reverse=True)
+    for slot, influence in enumerate(influences[:num_influences]):
+      bone_weights[vert_index, slot], bone_indices[vert_index, slot] = influence
+  
+  # normalize, and quantize so every influenced vertex sums up to exactly 1
+  weight_type = numpy.uint8 if export_options["SKIN_WEIGHT_BITS"] == 8 else numpy.uint16
+  weight_max = numpy.iinfo(weight_type).max
+  weight_sums = bone_weights.sum(axis=1)
+  influenced = weight_sums > 0
+  bone_weights[influenced] /= weight_sums[influenced, None]
+  quantized = numpy.round(bone_weights * weight_max).astype(numpy.int32)
+  
+  residual = weight_max - quantized.sum(axis=1)
+  rows = numpy.nonzero(influenced)[0]
+  quantized[rows, numpy.argmax(quantized[rows], axis=1)] += residual[rows]
+  
+  index_type = numpy.uint8 if len(bone_map) <= 256 else numpy.uint16
+  
+  # write chunk
+  ptr = create_chunk(file, "SKIN", 1, get_uuid())
+  set_chunk_hints(file, vertices=num_vertices, indices=num_vertices * num_influences)
+  file.write(UINT32.pack(armature_map[armature.name]))
+  file.write(SKIN_HEADER.pack(num_influences, numpy.dtype(index_type).itemsize, numpy.dtype(weight_type).itemsize, len(bone_map)))
+  file.write(UINT32.pack(num_vertices))
+  
+  # inverse bind matrices, taking mesh space to bone space at rest
+  mesh_to_armature = ob.matrix_world.inverted_safe() * armature_object.matrix_world
+  for bone in sorted(armature.bones, key=lambda bone: bone_map[bone.name]):
+    inverse_bind = (mesh_to_armature * bone.matrix_local).inverted_safe()
+    file.write(MATRIX4.pack(*[value for row in inverse_bind for value in row]))
+  
+  file.write(bone_indices.astype(index_type).tobytes())
+  file.write(quantized.astype(weight_type).tobytes())
+  
+  close_chunk(file, ptr)
   
 ######################################################
 # EXPORT HELPERS
 ######################################################
+def get_skin_armature(ob):
+  """armature object deforming a mesh object, or None"""
+  if ob.type != 'MESH' or len(ob.vertex_groups) == 0:
+    return None
+    
+  for mod in ob.modifiers:
+    if mod.type == 'ARMATURE' and mod.object is not None and mod.object.type == 'ARMATURE':
+      return mod.object
+      
+  if ob.parent is not None and ob.parent_type == 'ARMATURE':
+    return ob.parent
+  return None
+  
+
 def get_heirarchy_level(ob):
   level = 0
   
@@ -1066,12 +1359,7 @@ def get_heirarchy_level(ob):
   return level
 
 
-def angle2d(p1, p2):
-    s = p1[0] * p2[1] - p2[0] * p1[1] 
-    c = p1[0] * p2[0] + p1[1] * p2[1]
-    return math.atan2(s, c)
-
-    
+@functools.lru_cache(maxsize=None)
 def translate_data_path(path):
   seperated = path.split('"].')
   
@@ -1108,19 +1396,355 @@ def translate_data_path(path):
   print("Unable to translate animation path: " + path)
 
 
-def bounds(msh):
-    bnd_max = [-9999.0, -9999.0, -9999.0]
-    bnd_min = [9999.0, 9999.0, 9999.0]
-    for vert in msh.vertices:
-      bnd_min[0] = min(vert.co[0], bnd_min[0])
-      bnd_min[1] = min(vert.co[1], bnd_min[1])
-      bnd_min[2] = min(vert.co[2], bnd_min[2])
+class EvaluatedMeshes:
+    """meshes with modifiers applied, for the 'apply' modifier mode. owners are indexed once,
+    each mesh is evaluated once for everything reading it and removed when released"""
+    
+    def __init__(self):
+      self.owners = {}
+      for ob in bpy.data.objects:
+        if ob.type == 'MESH' and ob.data is not None:
+          self.owners.setdefault(ob.data.name, []).append(ob)
+      self.temporaries = {}
+    
+    def get(self, mesh):
+      # use mesh with modifiers applied if we only have one user & the export option was set
+      owners = self.owners.get(mesh.name, [])
+      if export_options["MODIFIER_MODE"] != 'apply' or mesh.users != 1 or len(owners) != 1:
+        return mesh
       
-      bnd_max[0] = max(vert.co[0], bnd_max[0])
-      bnd_max[1] = max(vert.co[1], bnd_max[1])
-      bnd_max[2] = max(vert.co[2], bnd_max[2])
-    bnd_center = [(bnd_min[0] + bnd_max[0]) / 2, (bnd_min[1] + bnd_max[1]) / 2, (bnd_min[2] + bnd_max[2]) / 2]
-    return bnd_min, bnd_max, bnd_center
+      # nothing to apply
+      owner = owners[0]
+      if len(owner.modifiers) == 0:
+        return mesh
+        
+      if mesh.name not in self.temporaries:
+        self.temporaries[mesh.name] = self.evaluate(owner)
+      return self.temporaries[mesh.name]
+    
+    def evaluate(self, owner):
+      # skinned meshes are written at rest, their SKIN chunk deforms them
+      hidden = []
+      if export_options["SKINNING"] and get_skin_armature(owner) is not None:
+        hidden = [mod for mod in owner.modifiers if mod.type == 'ARMATURE' and mod.show_viewport]
+      
+      for mod in hidden:
+        mod.show_viewport = False
+      try:
+        return owner.to_mesh(bpy.context.scene, apply_modifiers = True, settings='PREVIEW')
+      finally:
+        for mod in hidden:
+          mod.show_viewport = True
+    
+    def release(self, mesh):
+      if mesh.name in self.temporaries:
+        bpy.data.meshes.remove(self.temporaries.pop(mesh.name))
+    
+    def release_all(self):
+      for temporary in self.temporaries.values():
+        bpy.data.meshes.remove(temporary)
+      self.temporaries = {}
+
+
+def get_export_mesh(mesh):
+  if evaluated_meshes is None:
+    return mesh
+  return evaluated_meshes.get(mesh)
+
+
+def allocate_mapped(size, dtype):
+  """array backed by an anonymous temp file, so the os can page it out"""
+  if size == 0:
+    return numpy.empty(0, dtype=dtype)
+  return numpy.memmap(tempfile.TemporaryFile(), dtype=dtype, mode="w+", shape=(size,))
+
+
+def read_attribute(collection, attribute, dtype, components=1, allocate=numpy.empty):
+  """read one attribute of every item in a collection into a flat array"""
+  buffer = allocate(len(collection) * components, dtype)
+  collection.foreach_get(attribute, buffer)
+  if components > 1:
+    buffer.shape = (len(collection), components)
+  return buffer
+
+
+def estimate_mesh_bytes(mesh):
+  """rough size of everything extract_mesh_data pulls out of a mesh"""
+  vertex_bytes = 24 + 8 * len(mesh.uv_layers) + 12 * len(mesh.vertex_colors)
+  return 24 * len(mesh.vertices) + 14 * len(mesh.edges) + 12 * len(mesh.polygons) + (4 + vertex_bytes) * len(mesh.loops)
+
+
+def tessellate_mesh(source, data):
+  """triangulate a mesh the way blender does, so concave faces and n-gons stay inside
+  their outline. returns loop indices of every triangle, and the face it came from"""
+  bm = bmesh.new()
+  try:
+    bm.from_mesh(source)
+    bm.verts.index_update()
+    bm.faces.index_update()
+    
+    # tag faces with their polygon, triangulate copies the tag onto every piece
+    face_layer = bm.faces.layers.int.new("scn_face")
+    for face in bm.faces:
+      face[face_layer] = face.index
+    bmesh.ops.triangulate(bm, faces=[face for face in bm.faces if len(face.verts) > 3])
+    bm.verts.index_update()
+    
+    triangle_faces = numpy.array([face[face_layer] for face in bm.faces], dtype=numpy.int64)
+    corner_verts = numpy.array([vert.index for face in bm.faces for vert in face.verts], dtype=numpy.int64)
+  finally:
+    bm.free()
+  
+  # keep the triangles of a face together and faces in order
+  corner_verts.shape = (len(triangle_faces), 3)
+  order = numpy.argsort(triangle_faces, kind="mergesort")
+  triangle_faces = triangle_faces[order]
+  corner_verts = corner_verts[order]
+  
+  # a face uses each vertex once, so (face, vertex) finds the loop of every corner
+  loop_starts = data["loop_starts"].astype(numpy.int64)
+  loop_totals = data["loop_totals"].astype(numpy.int64)
+  face_offsets = numpy.cumsum(loop_totals) - loop_totals
+  loop_indices = numpy.repeat(loop_starts - face_offsets, loop_totals) + numpy.arange(loop_totals.sum())
+  loop_faces = numpy.empty(len(data["loop_verts"]), dtype=numpy.int64)
+  loop_faces[loop_indices] = numpy.repeat(numpy.arange(len(loop_totals)), loop_totals)
+  
+  num_verts = max(len(data["positions"]), 1)
+  loop_keys = loop_faces * num_verts + data["loop_verts"]
+  loop_order = numpy.argsort(loop_keys, kind="mergesort")
+  corner_keys = triangle_faces[:, None] * num_verts + corner_verts
+  triangles = loop_order[numpy.searchsorted(loop_keys[loop_order], corner_keys)].astype(numpy.int64)
+  return triangles, triangle_faces
+
+
+def extract_mesh_data(mesh, streamed=False):
+  """pull all geometry streams of a mesh out with foreach_get. streamed meshes
+  are read into temp file backed arrays instead of memory"""
+  source = get_export_mesh(mesh)
+  allocate = allocate_mapped if streamed else numpy.empty
+  
+  data = {}
+  data["name"] = mesh.name
+  data["auto_smooth"] = mesh.use_auto_smooth
+  data["num_materials"] = max(len(mesh.materials), 1)
+  data["uv_layers"] = [(uv_layer.name, mesh.uv_layers.active.name == uv_layer.name) for uv_layer in mesh.uv_layers]
+  data["vc_layers"] = [(vc_layer.name, vc_layer.active_render) for vc_layer in mesh.vertex_colors]
+  
+  data["positions"] = read_attribute(source.vertices, "co", numpy.float32, 3, allocate=allocate)
+  data["normals"] = read_attribute(source.vertices, "normal", numpy.float32, 3, allocate=allocate)
+  
+  data["edge_verts"] = read_attribute(source.edges, "vertices", numpy.int32, 2, allocate=allocate)
+  data["edge_smooth"] = ~read_attribute(source.edges, "use_edge_sharp", numpy.bool_, allocate=allocate)
+  data["edge_seam"] = read_attribute(source.edges, "use_seam", numpy.bool_, allocate=allocate)
+  data["edge_crease"] = read_attribute(source.edges, "crease", numpy.float32, allocate=allocate)
+  
+  data["loop_verts"] = read_attribute(source.loops, "vertex_index", numpy.int32, allocate=allocate)
+  data["loop_starts"] = read_attribute(source.polygons, "loop_start", numpy.int32, allocate=allocate)
+  data["loop_totals"] = read_attribute(source.polygons, "loop_total", numpy.int32, allocate=allocate)
+  data["material_indices"] = read_attribute(source.polygons, "material_index", numpy.int32, allocate=allocate)
+  
+  # layers are looked up by name, the evaluated mesh may order them differently
+  data["uvs"] = []
+  for uv_layer in mesh.uv_layers:
+    data["uvs"].append(read_attribute(source.uv_layers[uv_layer.name].data, "uv", numpy.float32, 2, allocate=allocate))
+    
+  data["colors"] = []
+  for vc_layer in mesh.vertex_colors:
+    vc_data = source.vertex_colors[vc_layer.name].data
+    num_channels = len(vc_data[0].color) if len(vc_data) > 0 else 3
+    data["colors"].append(read_attribute(vc_data, "color", numpy.float32, num_channels, allocate=allocate)[:, :3])
+  
+  # triangle streams are built from blender's own tessellation
+  if not streamed and (export_options["VERTEX_BUFFERS"] or export_options["OPTIMIZE_TRIANGLES"]):
+    data["triangles"], data["triangle_faces"] = tessellate_mesh(source, data)
+  
+  # everything has been copied out, the evaluated mesh isn't needed anymore
+  if evaluated_meshes is not None:
+    evaluated_meshes.release(mesh)
+  
+  return data
+
+
+def iterate_export_meshes(meshes, lod_owners):
+  """yield every mesh followed by its generated lods. lod names are logged
+  in lod_owners with the name of the mesh they came from"""
+  for mesh in meshes:
+    # lods come from the mesh as exported, before extracting it releases the evaluated copy.
+    # they're logged right away so they get removed even if the base mesh fails
+    lod_meshes = []
+    if export_options["LOD_LEVELS"] > 0:
+      lod_meshes = generate_lod_meshes(mesh, export_options["LOD_LEVELS"], export_options["LOD_RATIO"])
+      for lod_mesh in lod_meshes:
+        lod_owners[lod_mesh.name] = mesh.name
+    
+    yield mesh
+    for lod_mesh in lod_meshes:
+      yield lod_mesh
+
+
+def generate_lod_meshes(mesh, levels, ratio):
+  """decimate a mesh into a chain of lower detail copies, off scene. modifiers
+  are applied first when the export applies them"""
+  lod_meshes = []
+  
+  # the decimate modifier needs an object to live on, it's never linked to the scene
+  lod_object = bpy.data.objects.new(mesh.name + "_SCN_LOD", get_export_mesh(mesh))
+  try:
+    decimate = lod_object.modifiers.new("SCN_LOD", 'DECIMATE')
+    decimate.decimate_type = 'COLLAPSE'
+    
+    for level in range(1, levels + 1):
+      decimate.ratio = ratio ** level
+      lod_mesh = lod_object.to_mesh(bpy.context.scene, apply_modifiers = True, settings='PREVIEW')
+      lod_mesh.name = "%s_LOD%d" % (mesh.name, level)
+      lod_meshes.append(lod_mesh)
+  finally:
+    bpy.data.objects.remove(lod_object, do_unlink=True)
+    
+  return lod_meshes
+
+
+def get_mesh_chunk_types():
+  chunk_types = ["MESH"]
+  if export_options["VERTEX_BUFFERS"]:
+    chunk_types.append("VBUF")
+  return chunk_types
+
+
+def encode_meshes(meshes):
+  """extract meshes here and encode their chunks, on the encoder pool if there is one.
+  yields (mesh, {chunk type: payload}) in the order the meshes were given"""
+  pending = collections.deque()
+  max_pending = 2 * encoder_pool_size
+  chunk_types = get_mesh_chunk_types()
+  
+  for mesh in meshes:
+    # meshes too big to hold in memory are streamed straight into the file later,
+    # sized as exported since modifiers can add a lot of geometry
+    if estimate_mesh_bytes(get_export_mesh(mesh)) > export_options["STREAM_BUDGET"] * 1024 * 1024:
+      print("...streaming mesh " + mesh.name + ", too large to encode in memory")
+      data = extract_mesh_data(mesh, streamed=True)
+      stats = compute_mesh_stats(data)
+      mesh_stats_map[mesh.name] = stats
+      mesh_counts_map[mesh.name] = {"MESH" : (stats["vertex_count"], stats["loop_count"])}
+      pending.append((mesh, None, {"STREAM" : (data, stats)}, None, None))
+      continue
+    
+    # pull all geometry out in bulk, and gather stats everything else shares
+    data = extract_mesh_data(mesh)
+    stats = compute_mesh_stats(data)
+    mesh_stats_map[mesh.name] = stats
+    mesh_counts_map[mesh.name] = {}
+    
+    # reuse payloads of an earlier export if the data is identical
+    cache_key = None
+    payloads = {}
+    if mesh_cache is not None:
+      cache_key = mesh_cache_key(data)
+      for chunk_type in chunk_types:
+        # cached payloads start with their vertex and index count
+        payload = mesh_cache.get(cache_key + chunk_type)
+        if payload is not None:
+          mesh_counts_map[mesh.name][chunk_type] = MESH_COUNTS.unpack_from(payload)
+          payloads[chunk_type] = payload[MESH_COUNTS.size:]
+    
+    # encode whatever is left
+    missing_types = [chunk_type for chunk_type in chunk_types if chunk_type not in payloads]
+    encoded = None
+    job = None
+    if len(missing_types) > 0:
+      if encoder_pool is not None:
+        # the job is kept to encode it here if the workers die
+        job = (data, stats, missing_types)
+        encoded = encoder_pool.submit(pool_encode_mesh_chunks, data, stats, missing_types, export_options)
+      else:
+        encoded = encode_mesh_chunks(data, stats, missing_types, export_options)
+    pending.append((mesh, cache_key, payloads, encoded, job))
+    
+    # keep a bounded amount of extracted data in flight
+    while len(pending) > max_pending:
+      yield finish_mesh_encode(*pending.popleft())
+  
+  while len(pending) > 0:
+    yield finish_mesh_encode(*pending.popleft())
+
+
+def finish_mesh_encode(mesh, cache_key, payloads, encoded, job):
+  global encoder_pool
+  if isinstance(encoded, concurrent.futures.Future):
+    try:
+      encoded = encoded.result()
+    except concurrent.futures.process.BrokenProcessPool as e:
+      # workers died, this and every later mesh is encoded here
+      if encoder_pool is not None:
+        print("mesh encoder processes stopped, encoding on the main thread (%s)" % e)
+        encoder_pool.shutdown(wait=False)
+        encoder_pool = None
+      encoded = encode_mesh_chunks(*(job + (export_options,)))
+  
+  if encoded is not None:
+    encoded, counts, report = encoded
+    for line in report:
+      print("...encoded mesh " + mesh.name + ": " + line)
+    
+    for chunk_type, payload in encoded.items():
+      payloads[chunk_type] = payload
+      mesh_counts_map[mesh.name][chunk_type] = counts[chunk_type]
+      if mesh_cache is not None:
+        mesh_cache.put(cache_key + chunk_type, MESH_COUNTS.pack(*counts[chunk_type]) + payload)
+  return mesh, payloads
+
+
+def create_encoder_pool(num_workers):
+  """start the mesh encoder processes, returns None if that isn't possible here"""
+  global pool_encode_mesh_chunks, worker_module_path
+  
+  # workers import encode_scn as a top level module, importing it through
+  # the addon package would pull in bpy, which workers don't have.
+  # the path is taken out again once the export is done
+  addon_dir = os.path.dirname(os.path.abspath(__file__))
+  if addon_dir not in sys.path:
+    sys.path.append(addon_dir)
+    worker_module_path = addon_dir
+  
+  try:
+    import encode_scn
+    pool_encode_mesh_chunks = encode_scn.encode_mesh_chunks
+    
+    # spawned workers need a python interpreter, not the blender binary
+    multiprocessing.set_executable(getattr(bpy.app, "binary_path_python", None) or sys.executable)
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+  except (ImportError, OSError, ValueError) as e:
+    print("unable to start mesh encoder processes, encoding on the main thread (%s)" % e)
+    return None
+  
+  # workers only start on the first job, make sure they actually run
+  try:
+    pool.submit(abs, 0).result()
+  except (concurrent.futures.process.BrokenProcessPool, OSError) as e:
+    print("unable to start mesh encoder processes, encoding on the main thread (%s)" % e)
+    pool.shutdown(wait=False)
+    return None
+  return pool
+
+
+def mesh_cache_key(data):
+  """hash every buffer and setting that goes into a mesh payload"""
+  hasher = hashlib.sha1()
+  hasher.update(b"MESH:3,VBUF:1,COUNTS:1")
+  hasher.update(repr((export_options["MODIFIER_MODE"], export_options["OPTIMIZE_TRIANGLES"],
+                      export_options["VERTEX_ENCODING"], data["name"], data["auto_smooth"], data["num_materials"],
+                      data["uv_layers"], data["vc_layers"])).encode("utf-8"))
+  
+  buffers = [data["positions"], data["normals"], data["edge_verts"], data["edge_smooth"], data["edge_seam"],
+             data["edge_crease"], data["loop_verts"], data["loop_starts"], data["loop_totals"], data["material_indices"]]
+  if "triangles" in data:
+    buffers += [data["triangles"], data["triangle_faces"]]
+  for buffer in buffers + data["uvs"] + data["colors"]:
+    hasher.update(repr((buffer.dtype.str, buffer.shape)).encode("ascii"))
+    hasher.update(numpy.ascontiguousarray(buffer).tobytes())
+  return hasher.hexdigest()
+
 
 def truncate_format_string(format):
     """truncate or expand format string to 4 chars"""
@@ -1149,32 +1773,258 @@ def truncate_format_string(format):
 
 
 def write_texture_reference(file, texture, mapping, multiplier, blend_type, offset, scale):
-    file.write(struct.pack("<I", texture_map[texture.name]))
-    file.write(struct.pack("<HH", mapping, blend_type))
-    file.write(struct.pack("<f", multiplier))
-    file.write(struct.pack("<ff", offset[0], offset[1]))
-    file.write(struct.pack("<ff", scale[0], scale[1]))
+    file.write(TEXTURE_REFERENCE.pack(texture_map[texture.name], mapping, blend_type, multiplier, offset[0], offset[1], scale[0], scale[1]))
 
     
-def write_string(file, strng):
-    file.write(struct.pack("B", len(strng)))
-    file.write(strng.encode("ascii"))
-    
-    if (len(strng) % 2) == 0:
-      # write padding byte. hacky but it works
-      file.write("\x00".encode("ascii"))
-
-      
 def get_uuid():
     global current_id
     current_id += 1
     return current_id
 
     
-def create_chunk(file, type, version, id):
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# table of contents entry flags
+TOC_COMPRESSED = 1
+
+def copy_file_segment(source_path, target, length):
+    """copy the first length bytes of a file into target without holding them in memory.
+    uses the kernel to copy when target is a real file, buffered copies otherwise"""
+    with open(source_path, "rb") as source:
+      remaining = length
+      
+      # file to file, nothing passes through python
+      try:
+        target_fd = target.fileno()
+        target.flush()
+      except (AttributeError, OSError, ValueError):
+        target_fd = None
+        
+      if target_fd is not None:
+        for copy_function in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+          if copy_function is None:
+            continue
+          try:
+            while remaining > 0:
+              if copy_function is os.sendfile:
+                copied = os.sendfile(target_fd, source.fileno(), length - remaining, remaining)
+              else:
+                copied = copy_function(source.fileno(), target_fd, remaining)
+              if copied == 0:
+                break
+              remaining -= copied
+            break
+          except OSError:
+            # not supported between these two, only possible before anything was copied
+            if remaining != length:
+              raise
+      
+      # plain buffered copy
+      source.seek(length - remaining)
+      while remaining > 0:
+        data = source.read(min(COPY_BUFFER_SIZE, remaining))
+        if len(data) == 0:
+          break
+        target.write(data)
+        remaining -= len(data)
+        
+    if remaining > 0:
+      raise OSError("%s ended %d bytes early" % (source_path, remaining))
+
+
+WRITE_BLOCK_SIZE = 4 * 1024 * 1024
+WRITE_QUEUE_BLOCKS = 8
+
+class BackgroundWriter:
+    """file-like output stage. writes are gathered into large blocks and handed over a
+    bounded queue to a thread doing the actual I/O, so exporting and writing overlap"""
+    
+    def __init__(self, target, block_size=WRITE_BLOCK_SIZE, max_blocks=WRITE_QUEUE_BLOCKS):
+      self.target = target
+      self.block_size = block_size
+      self.block = bytearray()
+      self.blocks = queue.Queue(max_blocks)
+      self.error = None
+      
+      self.thread = threading.Thread(target=self.run, name="SCN writer", daemon=True)
+      self.thread.start()
+    
+    def run(self):
+      while True:
+        block = self.blocks.get()
+        try:
+          if block is None:
+            return
+          # after an error, keep draining so the exporter never blocks
+          if self.error is None:
+            self.target.write(block)
+        except Exception as e:
+          self.error = e
+        finally:
+          self.blocks.task_done()
+    
+    def check_error(self):
+      if self.error is not None:
+        raise self.error
+    
+    def write(self, data):
+      self.check_error()
+      length = len(data)
+      if len(self.block) + length > self.block_size:
+        self.send_block()
+        
+      if length >= self.block_size:
+        self.blocks.put(bytes(data))
+      else:
+        self.block += data
+      return length
+    
+    def send_block(self):
+      if len(self.block) > 0:
+        self.blocks.put(self.block)
+        self.block = bytearray()
+    
+    def flush(self):
+      """wait for everything written so far to reach the target"""
+      self.send_block()
+      self.blocks.join()
+      self.check_error()
+      self.target.flush()
+    
+    def fileno(self):
+      return self.target.fileno()
+    
+    def seekable(self):
+      return self.target.seekable()
+    
+    def seek(self, offset, whence=0):
+      self.flush()
+      return self.target.seek(offset, whence)
+    
+    def close(self):
+      try:
+        self.flush()
+      finally:
+        self.blocks.put(None)
+        self.thread.join()
+    
+    def abort(self):
+      """stop without writing anything still queued"""
+      self.block = bytearray()
+      self.error = self.error or OSError("export aborted")
+      self.blocks.put(None)
+      self.thread.join()
+
+
+class ChunkWriter:
+    """file-like wrapper assembling chunks in memory. each chunk is buffered until it's
+    closed, then written out in one go with its lengths already known, so the target
+    only ever sees sequential writes and doesn't have to be seekable. file contents
+    added with write_file aren't buffered, they're copied over when the chunk goes out.
+    every chunk written to the target is logged in toc"""
+    
+    def __init__(self, target):
+      self.target = target
+      self.written = 0
+      self.chunks = []
+      self.toc = []
+    
+    def write(self, data):
+      if len(self.chunks) > 0:
+        return self.chunks[-1][1][-1].write(data)
+      
+      self.target.write(data)
+      self.written += len(data)
+      return len(data)
+    
+    def write_file(self, source_path, length):
+      if len(self.chunks) > 0:
+        # remember it, and carry on buffering after it
+        self.chunks[-1][1].extend([(source_path, length), io.BytesIO()])
+        return
+      
+      copy_file_segment(source_path, self.target, length)
+      self.written += length
+    
+    def tell(self):
+      return self.written + sum(part_length(part) for chunk in self.chunks for part in chunk[1])
+    
+    def seekable(self):
+      return len(self.chunks) == 0 and self.target.seekable()
+    
+    def patch(self, offset, data):
+      """overwrite already written data, only when nothing is buffered and the target can seek"""
+      self.target.seek(offset)
+      self.target.write(data)
+      self.target.seek(0, 2)
+    
+    def begin_chunk(self, type, version, id, spool=False):
+      # chunks too big for memory go to a temp file
+      buffer = tempfile.TemporaryFile() if spool else io.BytesIO()
+      self.chunks.append(((type, version, id), [buffer], [0, 0, 0]))
+    
+    def set_hints(self, vertices, indices, keys):
+      self.chunks[-1][2][:] = [vertices, indices, keys]
+    
+    def log_chunk(self, type, version, id, flags, size, hints):
+      # only chunks going straight to the target have a known offset
+      if len(self.chunks) == 0:
+        self.toc.append((id, type, version, flags, self.written, size) + tuple(hints))
+    
+    def write_chunk_bytes(self, chunk, hints=(0, 0, 0)):
+      """write a chunk someone else assembled"""
+      info_length, version, id = CHUNK_INFO.unpack_from(chunk, 16)
+      flags = TOC_COMPRESSED if chunk[28:32] == b"DATZ" else 0
+      self.log_chunk(bytes(chunk[8:12]).decode("ascii"), version, id, flags, len(chunk), hints)
+      self.write(chunk)
+    
+    def end_chunk(self):
+      (type, version, id), parts, hints = self.chunks.pop()
+      data_length = sum(part_length(part) for part in parts)
+      
+      self.log_chunk(type, version, id, 0, data_length + 36, hints)
+      self.write(b"".join([b"LIST", UINT32.pack(data_length + 28), type.encode("ascii"),
+                           b"INFO", CHUNK_INFO.pack(8, version, id),
+                           b"DATA", UINT32.pack(data_length)]))
+      for part in parts:
+        if isinstance(part, tuple):
+          self.write_file(*part)
+        elif isinstance(part, io.BytesIO):
+          self.write(part.getbuffer())
+          part.close()
+        else:
+          part.seek(0)
+          shutil.copyfileobj(part, self)
+          part.close()
+
+
+def set_chunk_hints(file, vertices=0, indices=0, keys=0):
+    """allocation hints of the chunk being written, for the table of contents"""
+    if isinstance(file, ChunkWriter):
+      file.set_hints(vertices, indices, keys)
+
+
+def part_length(part):
+    return part[1] if isinstance(part, tuple) else part.tell()
+
+
+def write_file_contents(file, source_path, length):
+    """write a file into a chunk, streamed rather than read whole"""
+    if isinstance(file, ChunkWriter):
+      file.write_file(source_path, length)
+    else:
+      copy_file_segment(source_path, file, length)
+
+    
+def create_chunk(file, type, version, id, spool=False):
     # verify length
     if(len(type) != 4):
       raise Exception("create_chunk got invalid type! (given " + type + ")")
+    
+    # chunk writers know the lengths when the chunk is closed
+    if isinstance(file, ChunkWriter):
+      file.begin_chunk(type, version, id, spool)
+      return None
       
     # get ptr
     ptr = file.tell()
@@ -1184,7 +2034,7 @@ def create_chunk(file, type, version, id):
     
     # write INFO chunk
     file.write("INFO".encode("ascii"))
-    file.write(struct.pack("<III", 8, version, id)) #8 length for 2 ints
+    file.write(CHUNK_INFO.pack(8, version, id)) #8 length for 2 ints
 
     # write DATA chunk header
     file.write("DATAxxxx".encode("ascii"))
@@ -1193,6 +2043,10 @@ def create_chunk(file, type, version, id):
 
 
 def close_chunk(file, ptr):
+    if isinstance(file, ChunkWriter):
+      file.end_chunk()
+      return
+    
     # get difference
     difference = file.tell() - ptr
     list_length = difference - 8
@@ -1200,16 +2054,82 @@ def close_chunk(file, ptr):
     
     # write LIST length
     file.seek(ptr + 4)
-    file.write(struct.pack("<I", list_length))
+    file.write(UINT32.pack(list_length))
     
     # write DATA length
     file.seek(24, 1)
-    file.write(struct.pack("<I", data_length))
+    file.write(UINT32.pack(data_length))
     
     # seek back to end
     file.seek(0, 2)
 
     
+def compress_chunk(chunk, method):
+    """turn a finished LIST/INFO/DATA chunk into a LIST/INFO/DATZ chunk. DATZ holds the
+    uncompressed length, the method and the compressed DATA payload. chunks that don't
+    shrink are returned as they are"""
+    payload = memoryview(chunk)[36:]
+    if method == 'zlib':
+      packed = zlib.compress(payload, 6)
+      method_id = 1
+    else:
+      packed = lzma.compress(payload)
+      method_id = 2
+    
+    if len(packed) + 8 >= len(payload):
+      return chunk
+    
+    # pad to an even length like everything else in the file
+    padding = b"\x00" if (len(packed) % 2) > 0 else b""
+    data_length = 8 + len(packed)
+    list_length = 28 + data_length + len(padding)
+    
+    return b"".join([b"LIST", UINT32.pack(list_length), chunk[8:28],
+                     b"DATZ", DATZ_HEADER.pack(data_length, len(payload), method_id, 0),
+                     packed, padding])
+
+
+class ChunkCompressionQueue:
+    """writes chunks through the compressor threads, in the order they were written.
+    chunk writers run right away so IDs are handed out as usual, only the output is deferred"""
+    
+    def __init__(self, file):
+      self.file = file
+      self.pending = collections.deque()
+    
+    def write_chunk(self, writer, *args):
+      # nothing to do if we aren't compressing
+      if compressor_pool is None:
+        writer(self.file, *args)
+        return
+        
+      buffer = io.BytesIO()
+      chunk_writer = ChunkWriter(buffer)
+      writer(chunk_writer, *args)
+      hints = chunk_writer.toc[-1][6:] if len(chunk_writer.toc) > 0 else (0, 0, 0)
+      self.pending.append((compressor_pool.submit(compress_chunk, buffer.getvalue(), export_options["COMPRESSION"]), hints))
+      
+      # write out whatever is finished, and don't let too much pile up
+      while len(self.pending) > 0 and (self.pending[0][0].done() or len(self.pending) > 2 * compressor_pool_size):
+        self.write_finished()
+    
+    def write_chunk_direct(self, writer, *args):
+      # for chunks too large to buffer, these go out uncompressed
+      self.flush()
+      writer(self.file, *args)
+    
+    def write_finished(self):
+      compressed, hints = self.pending.popleft()
+      if isinstance(self.file, ChunkWriter):
+        self.file.write_chunk_bytes(compressed.result(), hints)
+      else:
+        self.file.write(compressed.result())
+    
+    def flush(self):
+      while len(self.pending) > 0:
+        self.write_finished()
+
+
 def create_chunk_map():
     return None
 ######################################################
@@ -1220,8 +2140,8 @@ def export_scene(file):
     global current_id
     current_id = -1
     
-    # write RIFF header
-    file.write("RIFFxxxxSCNE".encode("ascii"))
+    # write RIFF header, the length stays unknown if it can't be filled in later
+    file.write(b"RIFF" + UINT32.pack(0xFFFFFFFF) + b"SCNE")
     
     # write info
     write_file_chunk(file)
@@ -1237,21 +2157,31 @@ def export_scene(file):
                  
     write_meta_chunk(file, meta_test)
     
+    # nothing has been embedded yet
+    global embedded_resources
+    embedded_resources = {}
+    
     # write actions
     global action_map
     action_map = {}
     
+    chunks = ChunkCompressionQueue(file)
     for act in bpy.data.actions:
-      write_anim_chunk(file, act)
+      chunks.write_chunk(write_anim_chunk, act)
       action_map[act.name] = current_id
+    chunks.flush()
 
     # write sounds
     global sound_map
     sound_map = {}
     
+    # embedded files are streamed from disk, they'd have to be held in memory to compress
+    write_resource_chunk = chunks.write_chunk_direct if export_options["EMBED_RESOURCES"] else chunks.write_chunk
+    
     for snd in bpy.data.sounds:
-      write_sound_resource_chunk(file, snd)
+      write_resource_chunk(write_sound_resource_chunk, snd)
       sound_map[snd.name] = current_id
+    chunks.flush()
     
     # write speakers
     global speaker_map
@@ -1282,8 +2212,9 @@ def export_scene(file):
     texture_map = {}
     
     for txtr in bpy.data.textures:
-      write_texture_resource_chunk(file, txtr)
+      write_resource_chunk(write_texture_resource_chunk, txtr)
       texture_map[txtr.name] = current_id
+    chunks.flush()
     
     # write materials
     global material_map
@@ -1297,37 +2228,82 @@ def export_scene(file):
       write_material_chunk(file, mtrl)
       material_map[mtrl.name] = current_id
     
-    # write armatures
-    global armature_map
-    armature_map = {}
-    
-    for arma in bpy.data.armatures:
-      write_armature_chunk(file, arma)
-      armature_map[arma.name] = current_id
+    # modifiers are applied once, for skins and meshes alike
+    global evaluated_meshes
+    evaluated_meshes = EvaluatedMeshes()
+    lod_owners = {}
+    try:
+      # write armatures
+      global armature_map
+      armature_map = {}
+    
+      global bone_maps, skin_map
+      bone_maps = {}
+      skin_map = {}
+    
+      for arma in bpy.data.armatures:
+        write_armature_chunk(file, arma)
+        armature_map[arma.name] = current_id
       
-    # write curves
-    global curve_map
-    curve_map = {}
-    
-    for curve in bpy.data.curves:
-      curve_splines = curve.splines
-      spline_count = len(curve_splines)
-      for cspline in range(spline_count):
-        write_spline_chunk(file, curve.resolution_u, curve_splines[cspline])
-        curve_map[curve.name + "_SCN_EXPORT_ID_" + str(cspline)] = current_id
-    
-    # write meshes
-    global mesh_map
-    mesh_map = {}
-    
-    for mesh in bpy.data.meshes:
+        # per vertex skinning of everything this armature deforms
+        if export_options["SKINNING"]:
+          for ob in bpy.data.objects:
+            armature_object = get_skin_armature(ob)
+            if armature_object is not None and armature_object.data == arma:
+              # weights are per vertex of the original mesh
+              if len(get_export_mesh(ob.data).vertices) != len(ob.data.vertices):
+                print("...not skinning " + ob.name + ", its modifiers change the vertex count")
+                continue
+              write_skin_chunk(file, ob, armature_object)
+              skin_map[ob.name] = current_id
+      
+      # write curves
+      global curve_map
+      curve_map = {}
+    
+      for curve in bpy.data.curves:
+        curve_splines = curve.splines
+        spline_count = len(curve_splines)
+        for cspline in range(spline_count):
+          write_spline_chunk(file, curve.resolution_u, curve_splines[cspline])
+          curve_map[curve.name + "_SCN_EXPORT_ID_" + str(cspline)] = current_id
+    
+      # write meshes
+      global mesh_map, mesh_stats_map, mesh_counts_map
+      mesh_map = {}
+      mesh_stats_map = {}
+      mesh_counts_map = {}
+    
+      global lod_map
+      lod_map = {}
+    
       # don't write unused stuff
-      if mesh.users == 0:
-        continue
+      used_meshes = [mesh for mesh in bpy.data.meshes if mesh.users > 0]
+    
+      # lod meshes are generated as we go, and removed when we're done
+      for mesh, payloads in encode_meshes(iterate_export_meshes(used_meshes, lod_owners)):
+        print("...writing mesh " + mesh.name)
+        if "STREAM" in payloads:
+          chunks.write_chunk_direct(write_mesh_chunk, mesh, payloads)
+        else:
+          chunks.write_chunk(write_mesh_chunk, mesh, payloads)
+        mesh_id = current_id
+        
+        if mesh.name in lod_owners:
+          lod_map[lod_owners[mesh.name]].append(mesh_id)
+        else:
+          mesh_map[mesh.name] = mesh_id
+          lod_map[mesh.name] = []
         
-      print("...writing mesh " + mesh.name)
-      write_mesh_chunk(file, mesh)
-      mesh_map[mesh.name] = current_id
+        # gpu ready buffers go right after their mesh
+        if "VBUF" in payloads:
+          chunks.write_chunk(write_vertex_buffer_chunk, mesh_id, payloads["VBUF"], mesh_counts_map[mesh.name].get("VBUF"))
+      chunks.flush()
+    finally:
+      for lod_name in lod_owners:
+        bpy.data.meshes.remove(bpy.data.meshes[lod_name])
+      evaluated_meshes.release_all()
+      evaluated_meshes = None
     
     # write userdata (custom props)
     global userdata_map
@@ -1411,8 +2387,9 @@ def export_scene(file):
         
         # write the vertex group chunk for me!! :)
         if len(ob.vertex_groups) > 0:
+          group_weights = gather_vertex_group_weights(ob)
           for group in ob.vertex_groups:
-            write_vertex_group_chunk(file, group, ob)
+            write_vertex_group_chunk(file, group, ob, group_weights[group.index])
             vertex_group_map[group.name] = current_id
           
         # write modifier chunks
@@ -1425,35 +2402,146 @@ def export_scene(file):
         write_object_chunk(file, ob)
         object_map[ob.name] = current_id
       
+    # write table of contents
+    if export_options["TABLE_OF_CONTENTS"]:
+      write_toc_chunk(file)
+      
     #finish off
-    file_length = file.tell()
-    file.seek(4)
-    file.write(struct.pack("<I", file_length - 8))
+    if file.seekable():
+      file.patch(4, UINT32.pack(file.tell() - 8))
 
 ######################################################
 # EXPORT
 ######################################################
 def save_scn(filepath,
              context):
+    # keep progress messages out of the file when it's going to stdout
+    if filepath == "-":
+      stream = sys.stdout.buffer
+      with contextlib.redirect_stdout(sys.stderr):
+        return save_scn_file(filepath, context, stream)
+    return save_scn_file(filepath, context)
+
+
+def save_scn_file(filepath,
+                  context,
+                  stream=None):
 
     print("exporting SCENE: %r..." % (filepath))
     time1 = time.clock()
 
+    # open the mesh cache
+    global mesh_cache
+    mesh_cache = None
+    if export_options["MESH_CACHE"]:
+      mesh_cache = ChunkCache(default_cache_directory(), export_options["MESH_CACHE_SIZE"] * 1024 * 1024)
+
+    # start mesh encoder processes, the interpreter they use is put back afterwards
+    global encoder_pool, encoder_pool_size, pool_encode_mesh_chunks, worker_module_path
+    previous_executable = multiprocessing.spawn.get_executable()
+    encoder_pool = None
+    encoder_pool_size = export_options["MESH_WORKERS"] if export_options["MESH_WORKERS"] > 0 else os.cpu_count()
+    if encoder_pool_size > 1:
+      encoder_pool = create_encoder_pool(encoder_pool_size)
+      
+    # start compressor threads, zlib and lzma release the GIL while they work
+    global compressor_pool, compressor_pool_size
+    compressor_pool = None
+    if export_options["COMPRESSION"] != 'none':
+      compressor_pool_size = os.cpu_count()
+      compressor_pool = concurrent.futures.ThreadPoolExecutor(max_workers=compressor_pool_size)
+
+    # open the companion resource pack
+    global resource_pack
+    resource_pack = None
+    if export_options["RELATIVITY"] == 'pak' and not export_options["EMBED_RESOURCES"]:
+      if stream is not None:
+        print("resource packs need a file to sit next to, referencing resources by absolute path")
+        export_options["RELATIVITY"] = 'abs'
+      else:
+        resource_pack = ResourcePack(pak_path_for(filepath))
+
     # write SCENE
-    binfile = open(filepath, 'wb')
-    export_scene(binfile)
-    binfile.close()
+    try:
+      if stream is not None:
+        export_scene(ChunkWriter(stream))
+        stream.flush()
+      else:
+        # write beside the target, it's only replaced once everything made it to disk
+        temp_path = filepath + ".tmp"
+        try:
+          with open(temp_path, 'wb') as binfile:
+            output = BackgroundWriter(binfile)
+            try:
+              export_scene(ChunkWriter(output))
+              output.close()
+            except BaseException:
+              output.abort()
+              raise
+          os.replace(temp_path, filepath)
+        except BaseException:
+          if os.path.exists(temp_path):
+            os.remove(temp_path)
+          raise
+      
+      if resource_pack is not None:
+        resource_pack.close()
+        resource_pack = None
+    finally:
+      if resource_pack is not None:
+        resource_pack.abort()
+        resource_pack = None
+      
+      if encoder_pool is not None:
+        encoder_pool.shutdown()
+        encoder_pool = None
+      encoder_pool_size = 1
+      multiprocessing.set_executable(previous_executable)
+      
+      # the addon's modules shouldn't stay importable as top level ones
+      if worker_module_path is not None:
+        if worker_module_path in sys.path:
+          sys.path.remove(worker_module_path)
+        sys.modules.pop("encode_scn", None)
+        pool_encode_mesh_chunks = encode_mesh_chunks
+        worker_module_path = None
+      
+      if compressor_pool is not None:
+        compressor_pool.shutdown()
+        compressor_pool = None
     
     # SCENE export complete
     print(" done in %.4f sec." % (time.clock() - time1))
+    
+    if mesh_cache is not None:
+      print(" mesh cache: " + mesh_cache.summary())
+      mesh_cache = None
 
 
 def save(operator,
          context,
          filepath="",
-         embed_resources=False,
-         resource_path_mode=None,
+         embed_textures=False,
+         texture_path_mode='scn',
          modifier_mode = 'apply',
+         use_mesh_cache=False,
+         mesh_cache_size=1024,
+         mesh_workers=1,
+         vertex_buffers=False,
+         optimize_triangles=False,
+         lod_levels=0,
+         lod_ratio=0.5,
+         vertex_encoding='float',
+         compression='none',
+         stream_budget=512,
+         skinning=False,
+         skin_influences=4,
+         skin_weight_bits='16',
+         bake_animation=False,
+         bake_rate=30.0,
+         anim_tolerance=0.0,
+         anim_quantize_bits=0,
+         table_of_contents=False,
          ):
     
     # set up options
@@ -1461,9 +2549,27 @@ def save(operator,
     export_path = filepath
     export_options = {}
     
-    export_options["EMBED_RESOURCES"] = embed_resources
-    export_options["RELATIVITY"] = resource_path_mode
+    export_options["EMBED_RESOURCES"] = embed_textures
+    export_options["RELATIVITY"] = texture_path_mode
     export_options["MODIFIER_MODE"] = modifier_mode
+    export_options["MESH_CACHE"] = use_mesh_cache
+    export_options["MESH_CACHE_SIZE"] = mesh_cache_size
+    export_options["MESH_WORKERS"] = mesh_workers
+    export_options["VERTEX_BUFFERS"] = vertex_buffers
+    export_options["OPTIMIZE_TRIANGLES"] = optimize_triangles
+    export_options["LOD_LEVELS"] = lod_levels
+    export_options["LOD_RATIO"] = lod_ratio
+    export_options["VERTEX_ENCODING"] = vertex_encoding
+    export_options["COMPRESSION"] = compression
+    export_options["STREAM_BUDGET"] = stream_budget
+    export_options["SKINNING"] = skinning
+    export_options["SKIN_INFLUENCES"] = skin_influences
+    export_options["SKIN_WEIGHT_BITS"] = int(skin_weight_bits)
+    export_options["ANIM_BAKE"] = bake_animation
+    export_options["ANIM_BAKE_RATE"] = bake_rate
+    export_options["ANIM_TOLERANCE"] = anim_tolerance
+    export_options["ANIM_QUANTIZE_BITS"] = anim_quantize_bits
+    export_options["TABLE_OF_CONTENTS"] = table_of_contents
     
     # save it
     save_scn(filepath,
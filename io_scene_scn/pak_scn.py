@@ -0,0 +1,84 @@
+# ##### BEGIN LICENSE BLOCK #####
+#
+# This program is licensed under Creative Commons BY-NC-SA:
+# https://creativecommons.org/licenses/by-nc-sa/3.0/
+#
+# Copyright (C) Dummiesman, 2016
+#
+# ##### END LICENSE BLOCK #####
+
+# .scnpak layout:
+#   header      "SCNP", version, reserved, entry count, alignment, index offset
+#   entries     resource contents, each starting on an alignment boundary
+#   index       per entry offset, length, sha1 and name
+# offsets and lengths are absolute and 64 bit, so the pack can be mapped
+# and resources read straight out of it
+
+import os
+import struct
+
+from .encode_scn import write_string
+
+PAK_EXTENSION = ".scnpak"
+PAK_VERSION = 1
+PAK_ALIGNMENT = 4096
+
+PAK_HEADER = struct.Struct("<4sHHIIQ")
+PAK_ENTRY = struct.Struct("<QQ20s") # offset, length, sha1
+
+
+def pak_path_for(scene_path):
+    return os.path.splitext(scene_path)[0] + PAK_EXTENSION
+
+
+class ResourcePack:
+    """companion file holding resources of a scene, each stored once by content hash.
+    written to a temp file, it only replaces the old pack once closed"""
+
+    def __init__(self, path, alignment=PAK_ALIGNMENT):
+        self.path = path
+        self.temp_path = path + ".tmp"
+        self.alignment = alignment
+        self.entries = []
+        self.entries_by_digest = {}
+
+        self.file = open(self.temp_path, "wb")
+        self.file.write(PAK_HEADER.pack(b"SCNP", PAK_VERSION, 0, 0, alignment, 0))
+
+    def add(self, name, digest, length, write_contents):
+        """store a resource unless identical contents already are, write_contents(file)
+        writes exactly length bytes. returns the (offset, length) of the entry"""
+        if digest in self.entries_by_digest:
+            return self.entries_by_digest[digest]
+
+        # pad up to the next boundary
+        position = self.file.tell()
+        offset = -(-position // self.alignment) * self.alignment
+        self.file.write(b"\x00" * (offset - position))
+
+        write_contents(self.file)
+        if self.file.tell() != offset + length:
+            raise OSError("resource %s changed size while it was being packed" % name)
+
+        self.entries.append((offset, length, digest, name))
+        self.entries_by_digest[digest] = (offset, length)
+        return offset, length
+
+    def close(self):
+        # index goes last, the header points at it
+        index_offset = self.file.tell()
+        for offset, length, digest, name in self.entries:
+            self.file.write(PAK_ENTRY.pack(offset, length, digest))
+            write_string(self.file, name)
+
+        self.file.seek(0)
+        self.file.write(PAK_HEADER.pack(b"SCNP", PAK_VERSION, 0, len(self.entries), self.alignment, index_offset))
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
@@ -0,0 +1,81 @@
+# ##### BEGIN LICENSE BLOCK #####
+#
+# This program is licensed under Creative Commons BY-NC-SA:
+# https://creativecommons.org/licenses/by-nc-sa/3.0/
+#
+# Copyright (C) Dummiesman, 2016
+#
+# ##### END LICENSE BLOCK #####
+
+# every record written to a SCN file, compiled once. all of them are
+# little endian with no padding, whatever the machine exporting
+
+import struct
+
+# primitives
+UINT16 = struct.Struct("<H")
+INT16 = struct.Struct("<h")
+UINT32 = struct.Struct("<I")
+UINT64 = struct.Struct("<Q")
+INT32 = struct.Struct("<i")
+FLOAT = struct.Struct("<f")
+VEC2 = struct.Struct("<ff")
+VEC3 = struct.Struct("<fff")
+VEC4 = struct.Struct("<ffff")
+UINT16_PAIR = struct.Struct("<HH")
+
+# chunk framing
+CHUNK_INFO = struct.Struct("<III") # info length, version, id
+DATZ_HEADER = struct.Struct("<IIHH") # data length, uncompressed length, method, reserved
+
+# TOC
+TOC_ENTRY = struct.Struct("<I4sHHQQIII") # id, type, version, flags, offset, size, vertex, index and key counts
+
+# RSRC
+PAK_REFERENCE = struct.Struct("<QQ20s") # offset and length in the .scnpak, sha1 of the contents
+
+# OBJT
+OBJECT_TRANSFORM = struct.Struct("<9f") # location, rotation in degrees, scale
+OBJECT_STATE = struct.Struct("<IIHH") # parent id, layer mask, visible, selected
+
+# MTRL
+MATERIAL_COLORS = struct.Struct("<16f") # diffuse, specular, two reserved colors
+TEXTURE_REFERENCE = struct.Struct("<IHHfffff") # texture id, mapping, blend type, multiplier, offset, scale
+
+# COLL
+COLLISION_BOUNDS = struct.Struct("<6f") # center, half extents
+
+# RGDB
+RIGIDBODY = struct.Struct("<fffHH") # mass, linear damping, angular damping, kinematic, start deactivated
+
+# SJNT / HJNT / FJNT
+CONSTRAINT_INFO = struct.Struct("<HH") # collisions, breakable
+
+# SPLN
+SPLINE_HEADER = struct.Struct("<IHHHH") # point count, resolution, cyclic, type, tilt type
+SPLINE_POINT = struct.Struct("<6f") # position, radius, tilt, weight
+BEZIER_POINT = struct.Struct("<12f") # position, radius, tilt, weight, left handle, right handle
+
+# VTXG
+VERTEX_GROUP_RUN = struct.Struct("<II") # first and last vertex
+
+# ANIM
+ANIM_HEADER = struct.Struct("<ffI") # start, end, curve count
+
+# SKEL
+BONE = struct.Struct("<h7f") # parent, head, tail, roll
+
+# SKIN
+SKIN_HEADER = struct.Struct("<HHHH") # influences, index size, weight size, bone count
+MATRIX4 = struct.Struct("<16f")
+
+# mesh cache
+MESH_COUNTS = struct.Struct("<II") # vertex and index count, prefixed to a cached payload
+
+
+def pack_records(record, items):
+    """pack a sequence of value tuples back to back into one preallocated buffer"""
+    buffer = bytearray(record.size * len(items))
+    for index, values in enumerate(items):
+        record.pack_into(buffer, index * record.size, *values)
+    return buffer